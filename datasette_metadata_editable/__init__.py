@@ -1,16 +1,119 @@
+import asyncio
+import click
 import datetime
-import markdown2
-import nh3
 from datasette import Response, hookimpl, Forbidden
 from datasette.permissions import Action
+from datasette.utils import StartupError
+from datasette.utils.asgi import AsgiStream
 import json
+import logging
+import math
+import weakref
+import sqlite3
 from sqlite_utils import Database
+from .admission import EditAdmission
+from .bulk import chunks, write_column_edits
+from .catalog import matching_columns, validate_target
+from .diff import DiffCache, diff_fields
+from .embed import embedded_databases, load_embedded, read_embedded, sync_embedded
+from .fields import (
+    check_fields_config,
+    get_fields,
+    group_by_section,
+    md_to_html as md_to_html,  # Re-exported, it used to be defined here
+)
+from .history import (
+    HISTORY_FILTERS,
+    adjacent_revision_id,
+    get_revision,
+    iter_history_batches,
+    latest_revisions,
+    revision_fields,
+    revision_summary,
+    rows_to_csv,
+    rows_to_ndjson,
+)
 from .internal_migrations import migrations
-
-from functools import wraps
+from .sync import (
+    METADATA_TABLES,
+    entries_in_scope,
+    entries_to_metadata,
+    export_metadata,
+    import_metadata,
+    read_entries,
+)
+from .write_queue import WriteBehindQueue
+from .writes import apply_edits
+
+from functools import partial, wraps
 
 PERMISSION_EDIT_METADATA = "datasette-metadata-editable-edit"
 
+# Message shown after saving each type of target
+TARGET_MESSAGES = {
+    "instance": "Metadata updated",
+    "database": "Database metadata updated",
+    "table": "Table metadata updated",
+    "column": "Column metadata updated",
+}
+
+# Fields recorded in the edit history that identify the target, not metadata
+TARGET_FIELDS = ("target_type", "_database", "_table", "_column", "csrftoken")
+
+# Write-behind queues, only populated if write_behind is enabled in plugin config
+_write_queues = weakref.WeakKeyDictionary()
+# Computed revision diffs, created on first use
+_diff_caches = weakref.WeakKeyDictionary()
+# Rate limits, only populated if they are configured
+_admissions = weakref.WeakKeyDictionary()
+# Locks serialising syncs of embedded metadata, one per database name
+_embed_locks = weakref.WeakKeyDictionary()
+
+logger = logging.getLogger(__name__)
+
+
+def get_plugin_config(datasette):
+    return datasette.plugin_config("datasette-metadata-editable") or {}
+
+
+def get_write_queue(datasette):
+    return _write_queues.get(datasette)
+
+
+def get_admission(datasette):
+    return _admissions.get(datasette)
+
+
+def get_diff_cache(datasette):
+    if datasette not in _diff_caches:
+        _diff_caches[datasette] = DiffCache(
+            maxsize=int(get_plugin_config(datasette).get("diff_cache_size", 256))
+        )
+    return _diff_caches[datasette]
+
+
+def get_embed_lock(datasette, database_name):
+    locks = _embed_locks.setdefault(datasette, {})
+    if database_name not in locks:
+        locks[database_name] = asyncio.Lock()
+    return locks[database_name]
+
+
+async def sync_embedded_metadata(datasette, database_names):
+    """
+    Mirror changed metadata into any of these databases that embed it. The
+    edits are already saved, so failures are logged rather than raised - the
+    next successful sync catches up.
+    """
+    for db in embedded_databases(datasette, get_plugin_config(datasette)):
+        if db.name in database_names:
+            # Overlapping syncs could write older values over newer ones
+            async with get_embed_lock(datasette, db.name):
+                try:
+                    await sync_embedded(datasette, db)
+                except Exception:
+                    logger.exception("Failed to embed metadata in database %s", db.name)
+
 
 # decorator for routes, to ensure the proper permissions are checked
 def check_permission():
@@ -32,52 +135,52 @@ def check_permission():
     return decorator
 
 
-def md_to_html(md: str):
-    raw_html = markdown2.markdown(md)
-    return nh3.clean(raw_html)
+# decorator for routes that write edits, to apply any configured rate limits
+def admission_control():
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(scope, receive, datasette, request):
+            admission = get_admission(datasette)
+            if admission is None:
+                return await func(scope, receive, datasette, request)
+            write_queue = get_write_queue(datasette)
+            retry_after = admission.admit(
+                request.actor.get("id") if request.actor else None,
+                queued=len(write_queue.pending) if write_queue is not None else 0,
+            )
+            if retry_after is not None:
+                retry_after = math.ceil(retry_after)
+                return Response.text(
+                    "Too many edits, try again in {} second{}".format(
+                        retry_after, "" if retry_after == 1 else "s"
+                    ),
+                    status=429,
+                    headers={"Retry-After": str(retry_after)},
+                )
+            try:
+                return await func(scope, receive, datasette, request)
+            finally:
+                admission.release()
 
+        return wrapper
 
-def resolve_field(field):
-    return "description_html" if field == "description_markdown" else field
+    return decorator
 
 
-def resolve_value(data, field):
-    if field == "description_markdown":
-        return md_to_html(data.get(field))
-    return data.get(field)
-
-
-async def log_edit(
-    datasette, target_type, database, table, column, actor_id, fields: dict
-):
-    internal_db = datasette.get_internal_database()
-    sql = """
-    insert into datasette_metadata_editable_history
-        (target_type, database_name, resource_name, column_name, actor_id, updated_at, fields_json)
-            values
-        (:target_type, {database_name}, {resource_name}, {column_name}, {actor_id}, :updated_at, :fields_json)
-    """.format(
-        database_name=database and ":database_name" or "null",
-        resource_name=table and ":resource_name" or "null",
-        column_name=column and ":column_name" or "null",
-        actor_id=actor_id and ":actor_id" or "null",
-    )
-    await internal_db.execute_write(
-        sql,
-        {
-            "target_type": target_type,
-            "database_name": database,
-            "resource_name": table,
-            "column_name": column,
-            "actor_id": actor_id,
-            "updated_at": datetime.datetime.now().isoformat(),
-            "fields_json": json.dumps(
-                dict(
-                    (key, value) for key, value in fields.items() if key != "csrftoken"
-                )
-            ),
-        },
-    )
+def history_values(fields, registered):
+    """
+    The metadata keys and values that an edit recorded in the history resolves
+    to, for just the registered fields that a save would have written
+    """
+    values = {}
+    for field in registered:
+        if field.name in fields:
+            key, value = field.resolve(fields)
+            values[key] = value
+        elif field.key in fields:
+            # Imports record metadata keys rather than form field names
+            values[field.key] = fields[field.key]
+    return values
 
 
 async def get_last_edit(datasette, target_type, database, table, column):
@@ -141,20 +244,33 @@ class Routes:
         elif target_type == "column":
             defaults = await datasette.get_column_metadata(db, table, column)
 
-        # description_markdown is a special case, it comes from the edit log
+        # Fields with a renderer, like description_markdown, save the rendered
+        # value - their source comes from the edit log
+        fields = get_fields(get_plugin_config(datasette), target_type)
         last_edit = await get_last_edit(
             datasette, target_type, database=db, table=table, column=column
         )
-        if last_edit and last_edit["fields"].get("description_markdown"):
-            defaults["description_markdown"] = last_edit["fields"][
-                "description_markdown"
-            ]
+        for field in fields:
+            if field.renderer is not None:
+                if last_edit and last_edit["fields"].get(field.name):
+                    defaults[field.name] = last_edit["fields"][field.name]
+            elif field.key != field.name:
+                # The form looks up values by field name, not metadata key
+                defaults[field.name] = defaults.get(field.key)
+
+        # Edits still waiting in the write-behind queue take precedence
+        write_queue = get_write_queue(datasette)
+        if write_queue is not None:
+            pending = write_queue.get_pending(target_type, db, table, column)
+            if pending:
+                defaults = dict(defaults, **pending["fields"])
 
         return Response.html(
             await datasette.render_template(
                 "datasette_metadata_editable_edit.html",
                 {
                     "target_type": target_type,
+                    "sections": group_by_section(fields),
                     "defaults": defaults,
                     "database": db,
                     "table": table,
@@ -165,120 +281,284 @@ class Routes:
         )
 
     @check_permission()
+    @admission_control()
     async def api_edit(scope, receive, datasette, request):
         assert request.method == "POST"
         data = await request.post_vars()
-        redirect_url = None
-        message = None
         target_type = data.get("target_type")
+        if target_type not in TARGET_MESSAGES:
+            return Response.html("error", status=400)
+        database = data.get("_database") if target_type != "instance" else None
+        table = data.get("_table") if target_type in ("table", "column") else None
+        column = data.get("_column") if target_type == "column" else None
         actor_id = None
         if request.actor:
             actor_id = request.actor.get("id")
+        error = await validate_target(datasette, target_type, database, table, column)
+        if error:
+            return Response.text(error, status=400)
+
         if target_type == "instance":
-            for field in [
-                "title",
-                "description_markdown",
-                "source",
-                "license",
-                "source_url",
-                "license_url",
-            ]:
-                await datasette.set_instance_metadata(
-                    resolve_field(field), resolve_value(data, field)
-                )
-            await log_edit(
-                datasette,
-                target_type=target_type,
-                database=None,
-                table=None,
-                column=None,
-                actor_id=actor_id,
-                fields=data,
-            )
-            message = "Metadata updated"
             redirect_url = datasette.urls.instance()
         elif target_type == "database":
-            database = data.get("_database")
-            for field in [
-                "description_markdown",
-                "source",
-                "license",
-                "source_url",
-                "license_url",
-            ]:
-                await datasette.set_database_metadata(
-                    database, resolve_field(field), resolve_value(data, field)
-                )
-            await log_edit(
-                datasette,
-                target_type=target_type,
-                database=database,
-                table=None,
-                column=None,
-                actor_id=actor_id,
-                fields=data,
-            )
-            message = "Database metadata updated"
             redirect_url = datasette.urls.database(database)
-        elif target_type == "table":
-            database = data.get("_database")
-            table = data.get("_table")
-            for field in [
-                "description_markdown",
-                "source",
-                "license",
-                "source_url",
-                "license_url",
-            ]:
-                await datasette.set_resource_metadata(
-                    database, table, resolve_field(field), resolve_value(data, field)
+        else:
+            redirect_url = datasette.urls.table(database, table)
+
+        # Every registered field is saved, along with the history entry, in
+        # a single write
+        edit = {
+            "target_type": target_type,
+            "database": database,
+            "table": table,
+            "column": column,
+            "actor_id": actor_id,
+            "updated_at": datetime.datetime.now().isoformat(),
+            "values": dict(
+                field.resolve(data)
+                for field in get_fields(get_plugin_config(datasette), target_type)
+            ),
+            "fields": data,
+        }
+        write_queue = get_write_queue(datasette)
+        if write_queue is not None:
+            await write_queue.enqueue(edit)
+        else:
+            await datasette.get_internal_database().execute_write_fn(
+                partial(apply_edits, edits=[edit]), block=True
+            )
+            await sync_embedded_metadata(datasette, {database})
+        datasette.add_message(
+            request, TARGET_MESSAGES[target_type], type=datasette.INFO
+        )
+        return Response.redirect(redirect_url)
+
+    @check_permission()
+    @admission_control()
+    async def api_bulk_edit_columns(scope, receive, datasette, request):
+        if request.method != "POST":
+            return Response.json(
+                {"ok": False, "error": "Must be a POST request"}, status=405
+            )
+        data = await request.post_vars()
+        pattern = data.get("column")
+        if not pattern:
+            return Response.json(
+                {"ok": False, "error": "column= name or pattern is required"},
+                status=400,
+            )
+        # Only the fields included in the request are written
+        fields = [
+            field
+            for field in get_fields(get_plugin_config(datasette), "column")
+            if field.name in data
+        ]
+        if not fields:
+            return Response.json(
+                {"ok": False, "error": "No fields to update were provided"},
+                status=400,
+            )
+        payload = {field.name: data[field.name] for field in fields}
+        values = dict(field.resolve(payload) for field in fields)
+        columns = await matching_columns(datasette, pattern, data.get("database"))
+        actor_id = None
+        if request.actor:
+            actor_id = request.actor.get("id")
+        updated_at = datetime.datetime.now().isoformat()
+        # Queued edits must not overwrite these later
+        write_queue = get_write_queue(datasette)
+        if write_queue is not None:
+            await write_queue.flush()
+        internal_db = datasette.get_internal_database()
+        for chunk in chunks(columns):
+            await internal_db.execute_write_fn(
+                partial(
+                    write_column_edits,
+                    columns=chunk,
+                    payload=payload,
+                    values=values,
+                    actor_id=actor_id,
+                    updated_at=updated_at,
+                ),
+                block=True,
+            )
+        await sync_embedded_metadata(
+            datasette, {database for database, _, _ in columns}
+        )
+        return Response.json(
+            {
+                "ok": True,
+                "updated": len(columns),
+                "columns": [
+                    {"database": database, "table": table, "column": column}
+                    for database, table, column in columns
+                ],
+            }
+        )
+
+    @check_permission()
+    async def api_history(scope, receive, datasette, request):
+        format = request.url_vars["format"]
+        filters = {
+            key: request.args[key] for key in HISTORY_FILTERS if request.args.get(key)
+        }
+        internal_db = datasette.get_internal_database()
+
+        async def stream_fn(writer):
+            if format == "csv":
+                await writer.write(rows_to_csv([], header=True))
+            async for rows in iter_history_batches(internal_db, filters):
+                if format == "csv":
+                    await writer.write(rows_to_csv(rows))
+                else:
+                    await writer.write(rows_to_ndjson(rows))
+
+        return AsgiStream(
+            stream_fn,
+            headers={
+                "content-disposition": 'attachment; filename="history.{}"'.format(
+                    format
                 )
-            await log_edit(
-                datasette,
-                target_type=target_type,
-                database=database,
-                table=table,
-                column=None,
-                actor_id=actor_id,
-                fields=data,
+            },
+            content_type=(
+                "text/csv; charset=utf-8"
+                if format == "csv"
+                else "application/x-ndjson; charset=utf-8"
+            ),
+        )
+
+    @check_permission()
+    async def api_metadata(scope, receive, datasette, request):
+        db = request.args.get("db")
+        table = request.args.get("table")
+        column = request.args.get("column")
+        as_of = request.args.get("as_of")
+        if (table and not db) or (column and not table):
+            return Response.json(
+                {"ok": False, "error": "table= needs db=, and column= needs table="},
+                status=400,
             )
-            message = "Table metadata updated"
-            redirect_url = datasette.urls.table(database, table)
-        elif target_type == "column":
-            database = data.get("_database")
-            table = data.get("_table")
-            column = data.get("_column")
-            for field in [
-                "description_markdown",
-                "source",
-                "license",
-                "source_url",
-                "license_url",
-            ]:
-                await datasette.set_column_metadata(
-                    database,
-                    table,
-                    column,
-                    resolve_field(field),
-                    resolve_value(data, field),
+        internal_db = datasette.get_internal_database()
+        if not as_of:
+            entries = entries_in_scope(
+                await internal_db.execute_fn(read_entries), db, table, column
+            )
+            return Response.json(entries_to_metadata(entries))
+
+        try:
+            as_of = datetime.datetime.fromisoformat(as_of)
+        except ValueError:
+            return Response.json(
+                {"ok": False, "error": "as_of must be an ISO 8601 timestamp"},
+                status=400,
+            )
+        if as_of.tzinfo is not None:
+            # updated_at values are recorded in the server's local time
+            as_of = as_of.astimezone().replace(tzinfo=None)
+        as_of = as_of.isoformat()
+        config = get_plugin_config(datasette)
+        entries = {}
+        for row in await latest_revisions(internal_db, as_of, db, table, column):
+            if not (row["fields_json"] or "").strip().startswith("{"):
+                continue
+            values = {
+                key: value
+                for key, value in history_values(
+                    json.loads(row["fields_json"]),
+                    get_fields(config, row["target_type"]),
+                ).items()
+                if value is not None
+            }
+            if values:
+                target = (
+                    row["target_type"],
+                    row["database_name"],
+                    row["resource_name"],
+                    row["column_name"],
                 )
-            await log_edit(
-                datasette,
-                target_type=target_type,
-                database=None,
-                table=table,
-                column=column,
-                actor_id=actor_id,
-                fields=data,
+                entries[target] = values
+        return Response.json(entries_to_metadata(entries))
+
+    @check_permission()
+    async def api_diff(scope, receive, datasette, request):
+        internal_db = datasette.get_internal_database()
+        try:
+            to_id = int(request.args["to"])
+            from_id = int(request.args["from"]) if request.args.get("from") else None
+        except (KeyError, ValueError):
+            return Response.json(
+                {"ok": False, "error": "to= and from= must be revision IDs"},
+                status=400,
             )
-            message = "Column metadata updated"
-            redirect_url = datasette.urls.table(database, table)
-        if not redirect_url:
-            return Response.html("error", status=400)
-        else:
-            if message:
-                datasette.add_message(request, message, type=datasette.INFO)
-            return Response.redirect(redirect_url)
+        to_revision = await get_revision(internal_db, to_id)
+        if from_id is None and to_revision is not None:
+            # Default to the revision immediately before this one
+            from_id = await adjacent_revision_id(internal_db, to_revision, "previous")
+        from_revision = None
+        if from_id is not None:
+            from_revision = await get_revision(internal_db, from_id)
+        if to_revision is None or (from_id is not None and from_revision is None):
+            return Response.json(
+                {"ok": False, "error": "Revision not found"}, status=404
+            )
+        target = (
+            to_revision["target_type"],
+            to_revision["database_name"],
+            to_revision["resource_name"],
+            to_revision["column_name"],
+        )
+        if from_revision is not None and target != (
+            from_revision["target_type"],
+            from_revision["database_name"],
+            from_revision["resource_name"],
+            from_revision["column_name"],
+        ):
+            return Response.json(
+                {"ok": False, "error": "Revisions are for different targets"},
+                status=400,
+            )
+
+        diff_cache = get_diff_cache(datasette)
+        changes = diff_cache.get((from_id, to_id))
+        if changes is None:
+            changes = diff_fields(
+                revision_fields(from_revision),
+                revision_fields(to_revision),
+                ignore=TARGET_FIELDS,
+            )
+            diff_cache.set((from_id, to_id), changes)
+
+        return Response.json(
+            {
+                "target": dict(
+                    zip(("target_type", "database", "table", "column"), target)
+                ),
+                "from": revision_summary(from_revision),
+                "to": revision_summary(to_revision),
+                "changes": changes,
+                # For paging through the history of this target
+                "previous": (
+                    await adjacent_revision_id(internal_db, from_revision, "previous")
+                    if from_revision is not None
+                    else None
+                ),
+                "next": await adjacent_revision_id(internal_db, to_revision, "next"),
+            }
+        )
+
+    @check_permission()
+    async def api_stats(scope, receive, datasette, request):
+        write_queue = get_write_queue(datasette)
+        admission = get_admission(datasette)
+        return Response.json(
+            {
+                "write_queue": (
+                    write_queue.stats() if write_queue is not None else None
+                ),
+                "diff_cache": get_diff_cache(datasette).stats(),
+                "admission": admission.stats() if admission is not None else None,
+            }
+        )
 
 
 @hookimpl
@@ -296,6 +576,17 @@ def register_routes():
     return [
         (r"^/-/datasette-metadata-editable/edit$", Routes.edit_page),
         (r"^/-/datasette-metadata-editable/api/edit$", Routes.api_edit),
+        (r"^/-/datasette-metadata-editable/api/stats$", Routes.api_stats),
+        (r"^/-/datasette-metadata-editable/api/metadata$", Routes.api_metadata),
+        (r"^/-/datasette-metadata-editable/api/diff$", Routes.api_diff),
+        (
+            r"^/-/datasette-metadata-editable/api/bulk-edit-columns$",
+            Routes.api_bulk_edit_columns,
+        ),
+        (
+            r"^/-/datasette-metadata-editable/api/history\.(?P<format>ndjson|csv)$",
+            Routes.api_history,
+        ),
     ]
 
 
@@ -363,6 +654,13 @@ def table_actions(datasette, actor, database, table):
 @hookimpl
 def startup(datasette):
     async def inner():
+        config = get_plugin_config(datasette)
+        # Catch mistakes in the fields setting now, rather than on every edit
+        try:
+            check_fields_config(config)
+        except ValueError as ex:
+            raise StartupError("datasette-metadata-editable: {}".format(ex)) from ex
+
         def migrate(connection):
             with connection:
                 db = Database(connection)
@@ -370,4 +668,178 @@ def startup(datasette):
 
         await datasette.get_internal_database().execute_write_fn(migrate, block=True)
 
+        if config.get("write_behind") and datasette not in _write_queues:
+
+            async def on_flush(edits):
+                await sync_embedded_metadata(
+                    datasette, {edit["database"] for edit in edits}
+                )
+
+            _write_queues[datasette] = WriteBehindQueue(
+                datasette,
+                window=float(config.get("write_behind_window", 1.0)),
+                on_flush=on_flush,
+            )
+        if (
+            config.get("edits_per_second") or config.get("max_outstanding_edits")
+        ) and datasette not in _admissions:
+            _admissions[datasette] = EditAdmission(
+                rate=config.get("edits_per_second"),
+                burst=config.get("edit_burst"),
+                max_outstanding=config.get("max_outstanding_edits"),
+            )
+
+        databases = embedded_databases(datasette, config)
+        if databases:
+            # Creates the metadata_* tables if they do not exist yet
+            await datasette.refresh_schemas()
+            internal_db = datasette.get_internal_database()
+            for db in databases:
+                rows = await db.execute_fn(read_embedded)
+                if rows:
+                    await internal_db.execute_write_fn(
+                        partial(load_embedded, database_name=db.name, rows=rows),
+                        block=True,
+                    )
+            # Catch up on edits made while these databases were not attached
+            await sync_embedded_metadata(datasette, {db.name for db in databases})
+
     return inner
+
+
+def open_internal_database(path):
+    conn = sqlite3.connect(path)
+    db = Database(conn)
+    missing = [table for table in METADATA_TABLES if not db[table].exists()]
+    if missing:
+        raise click.ClickException(
+            "{} is missing {} - start Datasette with --internal {} first".format(
+                path, ", ".join(missing), path
+            )
+        )
+    with conn:
+        migrations.apply(db)
+    return conn
+
+
+@hookimpl
+def register_commands(cli):
+    @cli.group(name="metadata-editable")
+    def metadata_editable():
+        "Sync metadata edited with datasette-metadata-editable to and from files"
+
+    @metadata_editable.command(name="export")
+    @click.argument("internal", type=click.Path(exists=True, dir_okay=False))
+    @click.argument("metadata_file", type=click.Path(dir_okay=False))
+    def export_(internal, metadata_file):
+        "Write metadata from an internal database to a metadata.json/.yml file"
+        conn = open_internal_database(internal)
+        if export_metadata(conn, metadata_file):
+            click.echo("Wrote {}".format(metadata_file))
+        else:
+            click.echo("{} is already up to date".format(metadata_file))
+
+    @metadata_editable.command(name="import")
+    @click.argument("internal", type=click.Path(exists=True, dir_okay=False))
+    @click.argument("metadata_file", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--actor", help="Actor ID to record in the edit history")
+    def import_(internal, metadata_file, actor):
+        "Apply changes from a metadata.json/.yml file to an internal database"
+        conn = open_internal_database(internal)
+        edits = import_metadata(conn, metadata_file, actor_id=actor)
+        click.echo(
+            "Updated {} target{}".format(len(edits), "" if len(edits) == 1 else "s")
+        )
+
+    @metadata_editable.command(name="load-test")
+    @click.option("--actors", default=10, help="Number of concurrent editors")
+    @click.option("--edits", default=20, help="Edits made by each editor")
+    @click.option("--databases", default=2, help="Number of databases to create")
+    @click.option("--tables", default=5, help="Tables in each database")
+    @click.option("--columns", default=5, help="Columns in each table")
+    @click.option("--write-behind", is_flag=True, help="Enable write-behind mode")
+    @click.option(
+        "--write-behind-window", default=1.0, help="Write-behind window in seconds"
+    )
+    @click.option("--seed", default=0, help="Random seed for choosing targets")
+    @click.option("--json", "as_json", is_flag=True, help="Output the report as JSON")
+    def load_test(
+        actors,
+        edits,
+        databases,
+        tables,
+        columns,
+        write_behind,
+        write_behind_window,
+        seed,
+        as_json,
+    ):
+        "Measure how many concurrent editors the edit path can sustain"
+        from .load_test import run_load_test
+
+        report = asyncio.run(
+            run_load_test(
+                actors=actors,
+                edits_per_actor=edits,
+                databases=databases,
+                tables=tables,
+                columns=columns,
+                write_behind=write_behind,
+                write_behind_window=write_behind_window,
+                seed=seed,
+            )
+        )
+        if as_json:
+            click.echo(json.dumps(report, indent=2))
+            return
+        click.echo(
+            "{requests} requests from {actors} actors across {targets} targets "
+            "in {elapsed_seconds:.2f}s, {errors} errors".format(**report)
+        )
+        click.echo(
+            "{requests_per_second:.1f} requests/s, {saves_per_second:.1f} saves/s".format(
+                **report
+            )
+        )
+        for kind, latency in report["latency_ms"].items():
+            click.echo(
+                "{}: p50 {p50:.1f}ms, p90 {p90:.1f}ms, p99 {p99:.1f}ms, "
+                "max {max:.1f}ms".format(kind, **latency)
+            )
+        if report["write_queue_depth"] is None:
+            click.echo("Internal database write queue depth: unavailable")
+        else:
+            click.echo(
+                "Internal database write queue depth: max {max}, mean {mean:.2f}".format(
+                    **report["write_queue_depth"]
+                )
+            )
+        if report["write_behind"]:
+            click.echo(
+                "Write-behind coalescing ratio: {coalescing_ratio:.2f}".format(
+                    **report["write_behind"]
+                )
+            )
+
+
+@hookimpl
+def asgi_wrapper(datasette):
+    # Flush any pending write-behind edits before the server shuts down
+    def wrap_with_flush_on_shutdown(app):
+        async def wrapped(scope, receive, send):
+            if scope["type"] != "lifespan":
+                return await app(scope, receive, send)
+
+            async def receive_and_flush():
+                message = await receive()
+                if message["type"] == "lifespan.shutdown":
+                    write_queue = get_write_queue(datasette)
+                    if write_queue is not None:
+                        await write_queue.close()
+                return message
+
+            await app(scope, receive_and_flush, send)
+
+        return wrapped
+
+    return wrap_with_flush_on_shutdown
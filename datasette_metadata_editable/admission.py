@@ -0,0 +1,64 @@
+import time
+
+
+class EditAdmission:
+    """
+    Admission control for edits: a token bucket per actor, refilled at `rate`
+    edits per second up to `burst`, plus a global cap on edits that are
+    currently writing (or queued to write) to the internal database.
+    """
+
+    def __init__(self, rate=None, burst=None, max_outstanding=None, clock=None):
+        self.rate = rate
+        self.burst = burst or 1
+        self.max_outstanding = max_outstanding
+        self.clock = clock or time.monotonic
+        # actor_id -> (tokens, last refill time)
+        self.buckets = {}
+        self.outstanding = 0
+        self.admitted = 0
+        self.rejected_rate_limit = 0
+        self.rejected_outstanding = 0
+        self.peak_outstanding = 0
+
+    def admit(self, actor_id, queued=0):
+        """
+        Returns None if the edit can go ahead - in which case release() must
+        be called once it is done - or the number of seconds to wait before
+        trying again
+        """
+        if (
+            self.max_outstanding is not None
+            and self.outstanding + queued >= self.max_outstanding
+        ):
+            self.rejected_outstanding += 1
+            return 1.0
+        if self.rate:
+            now = self.clock()
+            tokens, last = self.buckets.get(actor_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[actor_id] = (tokens, now)
+                self.rejected_rate_limit += 1
+                return (1 - tokens) / self.rate
+            self.buckets[actor_id] = (tokens - 1, now)
+        self.admitted += 1
+        self.outstanding += 1
+        self.peak_outstanding = max(self.peak_outstanding, self.outstanding)
+        return None
+
+    def release(self):
+        self.outstanding -= 1
+
+    def stats(self):
+        return {
+            "edits_per_second": self.rate,
+            "edit_burst": self.burst,
+            "max_outstanding_edits": self.max_outstanding,
+            "outstanding": self.outstanding,
+            "peak_outstanding": self.peak_outstanding,
+            "admitted": self.admitted,
+            "rejected_rate_limit": self.rejected_rate_limit,
+            "rejected_outstanding": self.rejected_outstanding,
+            "actors_tracked": len(self.buckets),
+        }
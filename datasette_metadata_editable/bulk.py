@@ -0,0 +1,58 @@
+import json
+from .writes import apply_edits
+
+# Edits written per transaction, so other writers get a turn between chunks
+BULK_CHUNK_SIZE = 500
+
+
+def chunks(items, size=BULK_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def write_column_edits(conn, columns, payload, values, actor_id, updated_at):
+    """
+    Write the same values to each column in one transaction. Each history
+    entry records the fields from that column's previous entry with the
+    payload applied, so the latest entry still holds the column's full state.
+    """
+    previous = {}
+    for database, table, column, fields_json, _ in conn.execute(
+        """
+        select database_name, resource_name, column_name, fields_json, max(id)
+        from datasette_metadata_editable_history
+        where target_type = 'column'
+        and (database_name, resource_name, column_name) in (
+            select json_extract(value, '$[0]'), json_extract(value, '$[1]'),
+                json_extract(value, '$[2]')
+            from json_each(:columns)
+        )
+        group by database_name, resource_name, column_name
+        """,
+        {"columns": json.dumps([list(column) for column in columns])},
+    ):
+        if (fields_json or "").strip().startswith("{"):
+            previous[(database, table, column)] = json.loads(fields_json)
+    apply_edits(
+        conn,
+        [
+            {
+                "target_type": "column",
+                "database": database,
+                "table": table,
+                "column": column,
+                "actor_id": actor_id,
+                "updated_at": updated_at,
+                "values": values,
+                "fields": {
+                    **previous.get((database, table, column), {}),
+                    "target_type": "column",
+                    "_database": database,
+                    "_table": table,
+                    "_column": column,
+                    **payload,
+                },
+            }
+            for database, table, column in columns
+        ],
+    )
@@ -0,0 +1,74 @@
+async def matching_columns(datasette, pattern, database=None):
+    """
+    Columns across all attached databases whose name matches the GLOB pattern,
+    looked up in Datasette's catalog_columns table. refresh_schemas() only
+    re-introspects databases whose schema version has changed.
+    """
+    await datasette.refresh_schemas()
+    where_bits = ["name glob :pattern"]
+    if database:
+        where_bits.append("database_name = :database")
+    sql = """
+    select database_name, table_name, name from catalog_columns
+    where {where_clause}
+    order by database_name, table_name, cid
+    """.format(where_clause=" and ".join(where_bits))
+    return (
+        await datasette.get_internal_database().execute(
+            sql, {"pattern": pattern, "database": database}
+        )
+    ).rows
+
+
+async def validate_target(datasette, target_type, database, table, column):
+    "Returns an error message if the target does not exist, else None"
+    if target_type == "instance":
+        return None
+    if not database or database not in datasette.databases:
+        return "Database not found: {}".format(database)
+    if target_type == "database":
+        return None
+    if not table:
+        return "Table not found: {}".format(table)
+    db = datasette.databases[database]
+    await datasette.refresh_schemas()
+    internal_db = datasette.get_internal_database()
+    params = {"database": database, "table": table, "column": column}
+    kind = (
+        await internal_db.execute(
+            """
+            select 'table' from catalog_tables
+            where database_name = :database and table_name = :table
+            union all
+            select 'view' from catalog_views
+            where database_name = :database and view_name = :table
+            """,
+            params,
+        )
+    ).first()
+    # refresh_schemas() returns straight away if another refresh is running,
+    # so a miss is checked against the database itself before rejecting
+    if kind is None and not (
+        await db.table_exists(table) or await db.view_exists(table)
+    ):
+        return "Table not found: {}".format(table)
+    if target_type != "column":
+        return None
+    if not column:
+        return "Column not found: {}".format(column)
+    found = False
+    if kind is not None and kind[0] == "table":
+        found = (
+            await internal_db.execute(
+                """
+                select 1 from catalog_columns
+                where database_name = :database and table_name = :table
+                and name = :column
+                """,
+                params,
+            )
+        ).first() is not None
+    # The catalog does not record the columns of views
+    if not found and column not in await db.table_columns(table):
+        return "Column not found: {}".format(column)
+    return None
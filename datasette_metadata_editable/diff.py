@@ -0,0 +1,60 @@
+import difflib
+from collections import OrderedDict
+
+# Fields that get a line-by-line diff in addition to their before and after
+LINE_DIFF_FIELDS = ("description_markdown",)
+
+
+def diff_fields(old: dict, new: dict, ignore=()):
+    "List the fields that differ between two revisions, in sorted order"
+    changes = []
+    for field in sorted((old.keys() | new.keys()) - set(ignore)):
+        before, after = old.get(field), new.get(field)
+        if before == after:
+            continue
+        change = {"field": field, "from": before, "to": after}
+        if field in LINE_DIFF_FIELDS:
+            change["lines"] = list(
+                difflib.unified_diff(
+                    (before or "").splitlines(),
+                    (after or "").splitlines(),
+                    lineterm="",
+                )
+            )
+        changes.append(change)
+    return changes
+
+
+class DiffCache:
+    """
+    Least recently used cache of computed diffs keyed by revision pair. History
+    rows are never modified, so cached diffs never need to be invalidated.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.diffs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.diffs:
+            self.hits += 1
+            self.diffs.move_to_end(key)
+            return self.diffs[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, diff):
+        self.diffs[key] = diff
+        self.diffs.move_to_end(key)
+        while len(self.diffs) > self.maxsize:
+            self.diffs.popitem(last=False)
+
+    def stats(self):
+        return {
+            "maxsize": self.maxsize,
+            "size": len(self.diffs),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,209 @@
+import json
+
+EMBED_TABLE = "_datasette_metadata"
+
+CREATE_EMBED_TABLE_SQL = """
+create table if not exists {} (
+    -- 'database' | 'table' | 'column'
+    target_type text not null,
+    -- Uses empty string for "null" to enforce uniqueness
+    table_name text not null,
+    -- Uses empty string for "null" to enforce uniqueness
+    column_name text not null,
+    key text not null,
+    value text,
+    primary key (target_type, table_name, column_name, key)
+)
+""".format(EMBED_TABLE)
+
+# Only add entries the internal database does not have yet, so metadata
+# edited on this server is never replaced by an older copy in the file
+LOAD_SQL = {
+    "database": """
+      INSERT INTO metadata_databases(database_name, key, value)
+        VALUES(:database_name, :key, :value)
+        ON CONFLICT(database_name, key) DO NOTHING;
+    """,
+    "table": """
+      INSERT INTO metadata_resources(database_name, resource_name, key, value)
+        VALUES(:database_name, :resource_name, :key, :value)
+        ON CONFLICT(database_name, resource_name, key) DO NOTHING;
+    """,
+    "column": """
+      INSERT INTO metadata_columns(database_name, resource_name, column_name, key, value)
+        VALUES(:database_name, :resource_name, :column_name, :key, :value)
+        ON CONFLICT(database_name, resource_name, column_name, key) DO NOTHING;
+    """,
+}
+
+
+def embedded_databases(datasette, plugin_config):
+    """
+    The attached database files that metadata should be embedded in, from the
+    embed_metadata setting - either true for all of them or a list of names
+    """
+    setting = plugin_config.get("embed_metadata")
+    if not setting:
+        return []
+    return [
+        db
+        for name, db in datasette.databases.items()
+        if db.path and not db.is_memory and (setting is True or name in setting)
+    ]
+
+
+def read_embedded(conn):
+    if not conn.execute(
+        "select 1 from sqlite_master where type = 'table' and name = ?",
+        [EMBED_TABLE],
+    ).fetchone():
+        return []
+    return conn.execute(
+        "select target_type, table_name, column_name, key, value from {}".format(
+            EMBED_TABLE
+        )
+    ).fetchall()
+
+
+def load_embedded(conn, database_name, rows):
+    "Copy rows read from a database file into the internal metadata tables"
+    params = {}
+    for target_type, table, column, key, value in rows:
+        if target_type not in LOAD_SQL:
+            continue
+        params.setdefault(target_type, []).append(
+            {
+                "database_name": database_name,
+                "resource_name": table or None,
+                "column_name": column or None,
+                "key": key,
+                "value": value,
+            }
+        )
+    with conn:
+        for target_type, target_params in params.items():
+            conn.executemany(LOAD_SQL[target_type], target_params)
+
+
+def changed_targets(conn, database_name, last_history_id):
+    """
+    Targets in this database with history entries after last_history_id, and
+    their current metadata. Returns (max_history_id, {target: {key: value}})
+    """
+    max_id = conn.execute(
+        """
+        select max(id) from datasette_metadata_editable_history
+        where database_name = ? and id > ?
+        """,
+        [database_name, last_history_id],
+    ).fetchone()[0]
+    if max_id is None:
+        return last_history_id, {}
+    targets = {
+        tuple(row): {}
+        for row in conn.execute(
+            """
+            select distinct target_type, coalesce(resource_name, ''),
+                coalesce(column_name, '')
+            from datasette_metadata_editable_history
+            where database_name = ? and id > ? and id <= ?
+            and target_type in ('database', 'table', 'column')
+            """,
+            [database_name, last_history_id, max_id],
+        )
+    }
+    # Look up current values for just the changed targets
+    pairs = json.dumps([[table, column] for _, table, column in targets])
+    for target_type, sql in (
+        (
+            "database",
+            "select '', '', key, value from metadata_databases where database_name = :db",
+        ),
+        (
+            "table",
+            """
+            select resource_name, '', key, value from metadata_resources
+            where database_name = :db and resource_name in (
+                select json_extract(pair.value, '$[0]') from json_each(:pairs) as pair
+            )
+            """,
+        ),
+        (
+            "column",
+            """
+            select resource_name, column_name, metadata_columns.key,
+                metadata_columns.value
+            from metadata_columns
+            join json_each(:pairs) as pair
+              on resource_name = json_extract(pair.value, '$[0]')
+              and column_name = json_extract(pair.value, '$[1]')
+            where database_name = :db
+            """,
+        ),
+    ):
+        for table, column, key, value in conn.execute(
+            sql, {"db": database_name, "pairs": pairs}
+        ):
+            target = (target_type, table, column)
+            if target in targets and value is not None:
+                targets[target][key] = value
+    return max_id, targets
+
+
+def write_embedded(conn, targets):
+    "Replace the embedded rows for each changed target with its current values"
+    conn.execute(CREATE_EMBED_TABLE_SQL)
+    conn.executemany(
+        """
+        delete from {} where target_type = ? and table_name = ? and column_name = ?
+        """.format(EMBED_TABLE),
+        list(targets),
+    )
+    conn.executemany(
+        """
+        insert into {} (target_type, table_name, column_name, key, value)
+        values (?, ?, ?, ?, ?)
+        """.format(EMBED_TABLE),
+        [
+            (target_type, table, column, key, value)
+            for (target_type, table, column), values in targets.items()
+            for key, value in values.items()
+        ],
+    )
+
+
+async def sync_embedded(datasette, db):
+    """
+    Mirror metadata that has changed since the last sync into the database
+    file, using the edit history id as a change sequence. Returns the number
+    of targets that were written.
+    """
+    if not db.is_mutable:
+        return 0
+    internal_db = datasette.get_internal_database()
+    row = (
+        await internal_db.execute(
+            """
+            select last_history_id from datasette_metadata_editable_embedded
+            where database_name = ?
+            """,
+            [db.name],
+        )
+    ).first()
+    last_history_id = row[0] if row else 0
+    max_id, targets = await internal_db.execute_fn(
+        lambda conn: changed_targets(conn, db.name, last_history_id)
+    )
+    if max_id == last_history_id:
+        return 0
+    await db.execute_write_fn(lambda conn: write_embedded(conn, targets))
+    await internal_db.execute_write(
+        """
+        insert into datasette_metadata_editable_embedded (database_name, last_history_id)
+        values (?, ?)
+        on conflict(database_name) do update set last_history_id = excluded.last_history_id
+        where excluded.last_history_id > last_history_id
+        """,
+        [db.name, max_id],
+    )
+    return len(targets)
@@ -0,0 +1,155 @@
+import markdown2
+import nh3
+
+
+def md_to_html(md: str):
+    raw_html = markdown2.markdown(md)
+    return nh3.clean(raw_html)
+
+
+class Field:
+    """
+    A form field that can be edited for a target. `key` is the metadata key
+    it is saved under, after being passed through `renderer` if there is one.
+    """
+
+    def __init__(
+        self,
+        name,
+        label,
+        key=None,
+        renderer=None,
+        type="text",
+        section=None,
+        markdown_hint=False,
+    ):
+        self.name = name
+        self.label = label
+        self.key = key or name
+        self.renderer = renderer
+        self.type = type
+        self.section = section
+        self.markdown_hint = markdown_hint
+
+    def resolve(self, data):
+        "Returns (metadata key, value) for this field in submitted data"
+        value = data.get(self.name)
+        if self.renderer is not None and value is not None:
+            value = self.renderer(value)
+        return self.key, value
+
+
+ATTRIBUTION = "Licenses and Attribution"
+
+# Renderers that configured fields can use, by name
+RENDERERS = {"markdown": md_to_html}
+
+FIELD_DEFINITIONS = {
+    field.name: field
+    for field in (
+        Field("title", "Title"),
+        Field(
+            "description_markdown",
+            "Description",
+            key="description_html",
+            renderer=md_to_html,
+            type="textarea",
+            markdown_hint=True,
+        ),
+        Field("label_column", "Label column"),
+        Field("units", "Units"),
+        Field("source", "Source", section=ATTRIBUTION),
+        Field("license", "License", section=ATTRIBUTION),
+        Field("source_url", "Source URL", section=ATTRIBUTION),
+        Field("license_url", "License URL", section=ATTRIBUTION),
+        Field("about", "About", section=ATTRIBUTION),
+        Field("about_url", "About URL", section=ATTRIBUTION),
+    )
+}
+
+# Fields that can be edited for each target type, before any configured extras
+DEFAULT_FIELDS = {
+    "instance": [
+        "title",
+        "description_markdown",
+        "source",
+        "license",
+        "source_url",
+        "license_url",
+    ],
+    "database": [
+        "description_markdown",
+        "source",
+        "license",
+        "source_url",
+        "license_url",
+    ],
+    "table": [
+        "description_markdown",
+        "source",
+        "license",
+        "source_url",
+        "license_url",
+    ],
+    "column": [
+        "description_markdown",
+        "source",
+        "license",
+        "source_url",
+        "license_url",
+    ],
+}
+
+
+def field_from_config(config):
+    """
+    Configured fields are either the name of a field in FIELD_DEFINITIONS, the
+    name of a new plain text field, or a dictionary with name, label, type
+    ("text" or "textarea"), section, key and renderer (a name from RENDERERS)
+    keys
+    """
+    if isinstance(config, str):
+        if config in FIELD_DEFINITIONS:
+            return FIELD_DEFINITIONS[config]
+        config = {"name": config}
+    renderer = config.get("renderer")
+    if renderer is not None and renderer not in RENDERERS:
+        raise ValueError(
+            "Unknown renderer for field {}: {}".format(config["name"], renderer)
+        )
+    return Field(
+        config["name"],
+        config.get("label") or config["name"].replace("_", " ").capitalize(),
+        key=config.get("key"),
+        renderer=RENDERERS.get(renderer),
+        type=config.get("type") or "text",
+        section=config.get("section"),
+        markdown_hint=renderer == "markdown",
+    )
+
+
+def get_fields(plugin_config, target_type):
+    "The fields that can be edited for a target type, in save order"
+    fields = [FIELD_DEFINITIONS[name] for name in DEFAULT_FIELDS[target_type]]
+    for config in (plugin_config.get("fields") or {}).get(target_type) or []:
+        field = field_from_config(config)
+        if field.name not in [existing.name for existing in fields]:
+            fields.append(field)
+    return fields
+
+
+def check_fields_config(plugin_config):
+    "Raises ValueError if get_fields() cannot use the fields setting"
+    for target_type in plugin_config.get("fields") or {}:
+        if target_type not in DEFAULT_FIELDS:
+            raise ValueError("Unknown target type in fields: {}".format(target_type))
+    for target_type in DEFAULT_FIELDS:
+        get_fields(plugin_config, target_type)
+
+
+def group_by_section(fields):
+    "Returns [(section, fields)], with fields that have no section first"
+    sections = {None: []}
+    for field in fields:
+        sections.setdefault(field.section, []).append(field)
+    return [(section, fields) for section, fields in sections.items() if fields]
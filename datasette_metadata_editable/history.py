@@ -0,0 +1,166 @@
+import csv
+import io
+import json
+
+HISTORY_COLUMNS = (
+    "id",
+    "target_type",
+    "database_name",
+    "resource_name",
+    "column_name",
+    "actor_id",
+    "updated_at",
+    "fields_json",
+)
+
+# Query string arguments accepted as filters, and the where clause for each
+HISTORY_FILTERS = {
+    "target_type": "target_type = :target_type",
+    "database": "database_name = :database",
+    "table": "resource_name = :table",
+    "column": "column_name = :column",
+    "actor": "actor_id = :actor",
+    "since": "updated_at >= :since",
+    "until": "updated_at < :until",
+}
+
+
+async def iter_history_batches(internal_db, filters: dict, batch_size=1000):
+    """
+    Yield lists of history rows in id order. Each batch only scans the next
+    batch_size ids, so the work per query stays bounded however rare the
+    filtered rows are. Batches run with execute_fn(), outside Datasette's SQL
+    time limit - a limit hit partway through would truncate a response that
+    has already started streaming.
+    """
+    sql = """
+    select {columns} from datasette_metadata_editable_history
+    where {where_clause}
+    order by id
+    """.format(
+        columns=", ".join(HISTORY_COLUMNS),
+        where_clause=" and ".join(
+            ["id > :last_id and id <= :last_id + :batch_size"]
+            + [HISTORY_FILTERS[key] for key in filters]
+        ),
+    )
+    max_id = await internal_db.execute_fn(
+        lambda conn: conn.execute(
+            "select max(id) from datasette_metadata_editable_history"
+        ).fetchone()[0]
+    )
+    last_id = 0
+    while max_id is not None and last_id < max_id:
+        params = dict(filters, last_id=last_id, batch_size=batch_size)
+        rows = await internal_db.execute_fn(
+            lambda conn: conn.execute(sql, params).fetchall()
+        )
+        if rows:
+            yield rows
+        last_id += batch_size
+
+
+def rows_to_ndjson(rows):
+    return "".join(json.dumps(dict(row)) + "\n" for row in rows)
+
+
+def rows_to_csv(rows, header=False):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    if header:
+        writer.writerow(HISTORY_COLUMNS)
+    writer.writerows(tuple(row) for row in rows)
+    return output.getvalue()
+
+
+def scope_where_bits(database=None, table=None, column=None):
+    where_bits = []
+    if database:
+        where_bits.append("database_name = :database")
+    if table:
+        where_bits.append("resource_name = :table")
+    if column:
+        where_bits.append("column_name = :column")
+    return where_bits
+
+
+async def latest_revisions(internal_db, as_of, database=None, table=None, column=None):
+    """
+    The most recent history row at or before as_of for every target within
+    the given database, table or column. Each target's row is found with its
+    own lookup that seeks on the (target_type, database_name, resource_name,
+    column_name, updated_at) index, with ties broken by id.
+    """
+    where_bits = scope_where_bits(database, table, column)
+    sql = """
+    with targets as (
+        select distinct target_type, database_name, resource_name, column_name
+        from datasette_metadata_editable_history
+        {where_clause}
+    )
+    select history.target_type, history.database_name, history.resource_name,
+        history.column_name, history.fields_json, history.updated_at
+    from targets
+    join datasette_metadata_editable_history as history on history.id = (
+        select id from datasette_metadata_editable_history
+        where target_type = targets.target_type
+        and database_name is targets.database_name
+        and resource_name is targets.resource_name
+        and column_name is targets.column_name
+        and updated_at <= :as_of
+        order by updated_at desc, id desc
+        limit 1
+    )
+    """.format(where_clause="where " + " and ".join(where_bits) if where_bits else "")
+    return (
+        await internal_db.execute(
+            sql,
+            {"as_of": as_of, "database": database, "table": table, "column": column},
+        )
+    ).rows
+
+
+async def get_revision(internal_db, revision_id):
+    return (
+        await internal_db.execute(
+            "select {} from datasette_metadata_editable_history where id = ?".format(
+                ", ".join(HISTORY_COLUMNS)
+            ),
+            [revision_id],
+        )
+    ).first()
+
+
+async def adjacent_revision_id(internal_db, revision, direction):
+    "The id of the revision before or after this one for the same target"
+    sql = """
+    select id from datasette_metadata_editable_history
+    where target_type = :target_type
+    and database_name is :database_name
+    and resource_name is :resource_name
+    and column_name is :column_name
+    and id {op} :id
+    order by id {order}
+    limit 1
+    """.format(
+        op="<" if direction == "previous" else ">",
+        order="desc" if direction == "previous" else "asc",
+    )
+    row = (await internal_db.execute(sql, dict(revision))).first()
+    return row["id"] if row else None
+
+
+def revision_fields(revision):
+    if revision is None or not (revision["fields_json"] or "").strip().startswith("{"):
+        return {}
+    return json.loads(revision["fields_json"])
+
+
+def revision_summary(revision):
+    if revision is None:
+        return None
+    return {
+        "id": revision["id"],
+        "actor_id": revision["actor_id"],
+        "updated_at": revision["updated_at"],
+    }
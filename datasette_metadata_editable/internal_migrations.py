@@ -89,3 +89,19 @@ def m003_edit_history_table(db: Database):
     table.create_index(
         ["target_type", "database_name", "resource_name", "column_name", "updated_at"]
     )
+
+
+@migrations()
+def m004_history_index_by_database(db: Database):
+    # Used to find the latest revision of every target within a database
+    db["datasette_metadata_editable_history"].create_index(
+        ["database_name", "resource_name", "column_name", "target_type", "updated_at"]
+    )
+
+
+@migrations()
+def m005_embedded_sync_state(db: Database):
+    # The last history entry mirrored into each database file
+    db["datasette_metadata_editable_embedded"].create(
+        {"database_name": str, "last_history_id": int}, pk="database_name"
+    )
@@ -0,0 +1,185 @@
+import asyncio
+import pathlib
+import random
+import tempfile
+import time
+import sqlite_utils
+from datasette.app import Datasette
+from . import PERMISSION_EDIT_METADATA, get_write_queue
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+
+    def pick(p):
+        return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+    return {
+        "p50": pick(50),
+        "p90": pick(90),
+        "p99": pick(99),
+        "max": values[-1],
+    }
+
+
+def create_databases(directory, databases, tables, columns):
+    paths = []
+    for d in range(databases):
+        path = str(pathlib.Path(directory) / "db{}.db".format(d))
+        db = sqlite_utils.Database(path)
+        for t in range(tables):
+            db["t{}".format(t)].create(
+                dict(("c{}".format(c), str) for c in range(columns))
+            )
+        paths.append(path)
+    return paths
+
+
+def build_targets(databases, tables, columns):
+    targets = []
+    for d in range(databases):
+        database = "db{}".format(d)
+        targets.append(("database", database, None, None))
+        for t in range(tables):
+            table = "t{}".format(t)
+            targets.append(("table", database, table, None))
+            for c in range(columns):
+                targets.append(("column", database, table, "c{}".format(c)))
+    return targets
+
+
+async def run_load_test(
+    actors=10,
+    edits_per_actor=20,
+    databases=2,
+    tables=5,
+    columns=5,
+    write_behind=False,
+    write_behind_window=1.0,
+    seed=0,
+):
+    """
+    Simulate `actors` concurrent editors, each loading the edit page for a
+    random target and then saving it, `edits_per_actor` times. Returns a
+    report of throughput, latency percentiles in milliseconds and the depth
+    of the internal database write queue sampled while the test ran.
+    """
+    rng = random.Random(seed)
+    plugin_config = {}
+    if write_behind:
+        plugin_config = {
+            "write_behind": True,
+            "write_behind_window": write_behind_window,
+        }
+    with tempfile.TemporaryDirectory() as directory:
+        datasette = Datasette(
+            create_databases(directory, databases, tables, columns),
+            internal=str(pathlib.Path(directory) / "internal.db"),
+            config={
+                "permissions": {PERMISSION_EDIT_METADATA: True},
+                "plugins": {"datasette-metadata-editable": plugin_config},
+            },
+        )
+        await datasette.invoke_startup()
+        await datasette.refresh_schemas()
+        internal_db = datasette.get_internal_database()
+        targets = build_targets(databases, tables, columns)
+        latencies = {"edit_page": [], "api_edit": []}
+        queue_depths = []
+        errors = []
+
+        async def timed(kind, coroutine):
+            start = time.perf_counter()
+            response = await coroutine
+            latencies[kind].append((time.perf_counter() - start) * 1000)
+            if response.status_code not in (200, 302):
+                errors.append((kind, response.status_code))
+            return response
+
+        async def actor(actor_number):
+            cookies = {
+                "ds_actor": datasette.sign(
+                    {"a": {"id": "actor{}".format(actor_number)}}, "actor"
+                )
+            }
+            for edit_number in range(edits_per_actor):
+                target_type, database, table, column = rng.choice(targets)
+                args = {"db": database, "table": table, "column": column}
+                response = await timed(
+                    "edit_page",
+                    datasette.client.get(
+                        "/-/datasette-metadata-editable/edit",
+                        params={key: value for key, value in args.items() if value},
+                        cookies=cookies,
+                    ),
+                )
+                if "ds_csrftoken" in response.cookies:
+                    cookies["ds_csrftoken"] = response.cookies["ds_csrftoken"]
+                data = {
+                    "csrftoken": cookies.get("ds_csrftoken"),
+                    "target_type": target_type,
+                    "_database": database,
+                    "_table": table,
+                    "_column": column,
+                    "description_markdown": "Edit {} by actor {}".format(
+                        edit_number, actor_number
+                    ),
+                    "source": "load test",
+                }
+                await timed(
+                    "api_edit",
+                    datasette.client.post(
+                        "/-/datasette-metadata-editable/api/edit",
+                        data={key: value for key, value in data.items() if value},
+                        cookies=cookies,
+                    ),
+                )
+
+        # Datasette does not expose the depth of its write queue, so this
+        # reads a private attribute - if that goes away the depth is reported
+        # as unavailable rather than as an empty queue
+        queue_depth_available = hasattr(internal_db, "_write_queue")
+
+        async def sample_queue_depth():
+            while True:
+                write_queue = internal_db._write_queue
+                # The queue is created along with the first write
+                queue_depths.append(write_queue.qsize() if write_queue else 0)
+                await asyncio.sleep(0.005)
+
+        sampler = None
+        if queue_depth_available:
+            sampler = asyncio.create_task(sample_queue_depth())
+        start = time.perf_counter()
+        await asyncio.gather(*(actor(i) for i in range(actors)))
+        plugin_write_queue = get_write_queue(datasette)
+        if plugin_write_queue is not None:
+            await plugin_write_queue.close()
+        elapsed = time.perf_counter() - start
+        if sampler is not None:
+            sampler.cancel()
+
+    requests = len(latencies["edit_page"]) + len(latencies["api_edit"])
+    return {
+        "actors": actors,
+        "targets": len(targets),
+        "requests": requests,
+        "errors": len(errors),
+        "elapsed_seconds": elapsed,
+        "requests_per_second": requests / elapsed,
+        "saves_per_second": len(latencies["api_edit"]) / elapsed,
+        "latency_ms": {kind: percentiles(values) for kind, values in latencies.items()},
+        "write_queue_depth": (
+            {
+                "max": max(queue_depths, default=0),
+                "mean": sum(queue_depths) / len(queue_depths) if queue_depths else 0,
+            }
+            if queue_depth_available
+            else None
+        ),
+        "write_behind": (
+            plugin_write_queue.stats() if plugin_write_queue is not None else None
+        ),
+    }
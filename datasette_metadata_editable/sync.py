@@ -0,0 +1,199 @@
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import yaml
+from .writes import apply_edits
+
+METADATA_TABLES = (
+    "metadata_instance",
+    "metadata_databases",
+    "metadata_resources",
+    "metadata_columns",
+)
+
+
+def read_entries(conn):
+    """
+    Returns {(target_type, database, table, column): {key: value}} for every
+    non-null value in the metadata_* tables
+    """
+    entries = {}
+    queries = (
+        ("instance", "select null, null, null, key, value from metadata_instance"),
+        (
+            "database",
+            "select database_name, null, null, key, value from metadata_databases",
+        ),
+        (
+            "table",
+            "select database_name, resource_name, null, key, value from metadata_resources",
+        ),
+        (
+            "column",
+            "select database_name, resource_name, column_name, key, value from metadata_columns",
+        ),
+    )
+    for target_type, sql in queries:
+        for database, table, column, key, value in conn.execute(sql):
+            if value is None:
+                continue
+            entries.setdefault((target_type, database, table, column), {})[key] = value
+    return entries
+
+
+def entries_in_scope(entries, database=None, table=None, column=None):
+    "Filter entries down to a database, table or column and its descendants"
+    scope = [bit for bit in (database, table, column) if bit]
+    return {
+        target: values
+        for target, values in entries.items()
+        if list(target[1 : len(scope) + 1]) == scope
+    }
+
+
+def target_sort_key(target):
+    # Instance first, then each database followed by its tables and columns
+    return tuple(bit or "" for bit in target[1:])
+
+
+def entries_to_metadata(entries):
+    "Nest flat entries into a metadata.json style document"
+    metadata = {}
+    for (target_type, database, table, column), values in sorted(
+        entries.items(), key=lambda item: target_sort_key(item[0])
+    ):
+        if target_type == "instance":
+            metadata.update(values)
+            continue
+        db = metadata.setdefault("databases", {}).setdefault(database, {})
+        if target_type == "database":
+            db.update(values)
+            continue
+        resource = db.setdefault("tables", {}).setdefault(table, {})
+        if target_type == "table":
+            resource.update(values)
+        else:
+            resource.setdefault("columns", {})[column] = values
+    return metadata
+
+
+def metadata_to_entries(metadata):
+    "Flatten a metadata.json style document into entries"
+    entries = {}
+
+    def add(target, values):
+        values = {
+            key: value
+            for key, value in values.items()
+            if key not in ("databases", "tables", "columns", "queries")
+            and value is not None
+        }
+        if values:
+            entries[target] = {key: _to_string(value) for key, value in values.items()}
+
+    add(("instance", None, None, None), metadata)
+    for database, db in (metadata.get("databases") or {}).items():
+        add(("database", database, None, None), db)
+        for table, resource in (db.get("tables") or {}).items():
+            add(("table", database, table, None), resource)
+            for column, values in (resource.get("columns") or {}).items():
+                # Plain metadata.json files only have a description per column
+                if not isinstance(values, dict):
+                    values = {"description": values}
+                add(("column", database, table, column), values)
+    return entries
+
+
+def _to_string(value):
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def diff_entries(current, desired):
+    """
+    Returns {target: {key: value}} of the values that need writing to turn
+    current into desired. Keys missing from desired are set to None.
+    """
+    changes = {}
+    for target in sorted(current.keys() | desired.keys(), key=target_sort_key):
+        old = current.get(target, {})
+        new = desired.get(target, {})
+        changed = {
+            key: new.get(key)
+            for key in old.keys() | new.keys()
+            if old.get(key) != new.get(key)
+        }
+        if changed:
+            changes[target] = dict(sorted(changed.items()))
+    return changes
+
+
+def serialize(metadata, path):
+    if pathlib.Path(path).suffix == ".json":
+        return json.dumps(metadata, indent=2) + "\n"
+    return yaml.safe_dump(metadata, sort_keys=False, allow_unicode=True)
+
+
+def load_metadata_file(path):
+    content = pathlib.Path(path).read_text("utf-8")
+    if pathlib.Path(path).suffix == ".json":
+        return json.loads(content)
+    return yaml.safe_load(content) or {}
+
+
+def export_metadata(conn, path):
+    """
+    Write the current metadata to path, unless the file already has the same
+    content. Returns True if the file was written.
+    """
+    content = serialize(entries_to_metadata(read_entries(conn)), path).encode("utf-8")
+    path = pathlib.Path(path)
+    if path.exists():
+        existing = hashlib.sha256(path.read_bytes()).hexdigest()
+        if existing == hashlib.sha256(content).hexdigest():
+            return False
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+    return True
+
+
+def import_metadata(conn, path, actor_id=None):
+    """
+    Apply the differences between the metadata in path and the metadata_*
+    tables in one transaction, with a history entry per changed target.
+    Returns the list of edits that were applied.
+    """
+    desired = metadata_to_entries(load_metadata_file(path))
+    changes = diff_entries(read_entries(conn), desired)
+    updated_at = datetime.datetime.now().isoformat()
+    edits = []
+    for (target_type, database, table, column), values in changes.items():
+        fields = {"target_type": target_type}
+        if database:
+            fields["_database"] = database
+        if table:
+            fields["_table"] = table
+        if column:
+            fields["_column"] = column
+        # Record the full resulting state of the target, so the latest history
+        # row for a target is enough to reconstruct its metadata
+        fields.update(desired.get((target_type, database, table, column), {}))
+        fields.update(values)
+        edits.append(
+            {
+                "target_type": target_type,
+                "database": database,
+                "table": table,
+                "column": column,
+                "actor_id": actor_id,
+                "updated_at": updated_at,
+                "values": values,
+                "fields": fields,
+            }
+        )
+    apply_edits(conn, edits)
+    return edits
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from functools import partial
+from .writes import apply_edits
+
+logger = logging.getLogger(__name__)
+
+
+def target_key(edit):
+    return (edit["target_type"], edit["database"], edit["table"], edit["column"])
+
+
+class WriteBehindQueue:
+    """
+    In-process queue of accepted edits. Edits to the same target that arrive
+    within `window` seconds of each other are coalesced - the latest
+    submission wins - and everything pending is written in one transaction.
+    """
+
+    def __init__(self, datasette, window=1.0, on_flush=None):
+        self.datasette = datasette
+        self.window = window
+        # Optional async callback, called with each list of edits once written
+        self.on_flush = on_flush
+        self.pending = {}
+        # Number of submitted edits each pending edit stands in for
+        self.pending_counts = {}
+        self.lock = asyncio.Lock()
+        self.flush_task = None
+        self.edits_submitted = 0
+        self.edits_written = 0
+        # Submitted edits whose coalesced edit has been written
+        self.submitted_written = 0
+        self.flushes = 0
+
+    def get_pending(self, target_type, database, table, column):
+        return self.pending.get((target_type, database, table, column))
+
+    async def enqueue(self, edit):
+        self.edits_submitted += 1
+        key = target_key(edit)
+        # Re-insert so pending edits stay in the order they were last touched
+        self.pending.pop(key, None)
+        self.pending[key] = edit
+        self.pending_counts[key] = self.pending_counts.get(key, 0) + 1
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_after_window())
+
+    async def _flush_after_window(self):
+        # Keep going until nothing is pending, so edits that arrive while a
+        # flush is writing get their own window rather than waiting for the
+        # next save to start a new task
+        while self.pending:
+            await asyncio.sleep(self.window)
+            # Failed edits are logged and retried after the next window
+            await self.flush(raise_errors=False)
+
+    async def flush(self, raise_errors=True):
+        async with self.lock:
+            if not self.pending:
+                return
+            edits = list(self.pending.values())
+            counts = self.pending_counts
+            self.pending = {}
+            self.pending_counts = {}
+            try:
+                await self.datasette.get_internal_database().execute_write_fn(
+                    partial(apply_edits, edits=edits), block=True
+                )
+            except Exception:
+                logger.exception("Failed to write %d queued edits", len(edits))
+                self._restore(edits, counts)
+                if raise_errors:
+                    raise
+                return
+            self.edits_written += len(edits)
+            self.submitted_written += sum(counts.values())
+            self.flushes += 1
+            if self.on_flush is not None:
+                await self.on_flush(edits)
+
+    def _restore(self, edits, counts):
+        "Put edits from a failed flush back, unless their target has a newer one"
+        pending, pending_counts = self.pending, self.pending_counts
+        self.pending, self.pending_counts = {}, {}
+        for edit in edits:
+            key = target_key(edit)
+            if key not in pending:
+                self.pending[key] = edit
+            self.pending_counts[key] = counts[key]
+        for key, edit in pending.items():
+            self.pending[key] = edit
+            # The newer edit stands in for the failed ones it replaces
+            self.pending_counts[key] = (
+                self.pending_counts.get(key, 0) + pending_counts[key]
+            )
+
+    async def close(self):
+        # flush() waits on the lock, so any in-progress flush completes first
+        await self.flush(raise_errors=False)
+        if self.pending:
+            logger.error(
+                "%d queued edits could not be written before shutdown",
+                len(self.pending),
+            )
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+
+    def stats(self):
+        return {
+            "window": self.window,
+            "pending": len(self.pending),
+            "edits_submitted": self.edits_submitted,
+            "edits_written": self.edits_written,
+            "flushes": self.flushes,
+            # Accepted edits per row actually written, counting only edits
+            # that have been written, 1.0 means no coalescing
+            "coalescing_ratio": (
+                self.submitted_written / self.edits_written
+                if self.edits_written
+                else None
+            ),
+        }
@@ -0,0 +1,73 @@
+import json
+
+# Upsert statements for each target type, matching the ones Datasette uses in
+# its own set_*_metadata() methods, so they can be run on a single connection
+UPSERT_SQL = {
+    "instance": """
+      INSERT INTO metadata_instance(key, value)
+        VALUES(:key, :value)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value;
+    """,
+    "database": """
+      INSERT INTO metadata_databases(database_name, key, value)
+        VALUES(:database_name, :key, :value)
+        ON CONFLICT(database_name, key) DO UPDATE SET value = excluded.value;
+    """,
+    "table": """
+      INSERT INTO metadata_resources(database_name, resource_name, key, value)
+        VALUES(:database_name, :resource_name, :key, :value)
+        ON CONFLICT(database_name, resource_name, key) DO UPDATE SET value = excluded.value;
+    """,
+    "column": """
+      INSERT INTO metadata_columns(database_name, resource_name, column_name, key, value)
+        VALUES(:database_name, :resource_name, :column_name, :key, :value)
+        ON CONFLICT(database_name, resource_name, column_name, key) DO UPDATE SET value = excluded.value;
+    """,
+}
+
+HISTORY_SQL = """
+insert into datasette_metadata_editable_history
+    (target_type, database_name, resource_name, column_name, actor_id, updated_at, fields_json)
+        values
+    (:target_type, :database_name, :resource_name, :column_name, :actor_id, :updated_at, :fields_json)
+"""
+
+
+def history_fields_json(fields: dict):
+    return json.dumps(
+        dict((key, value) for key, value in fields.items() if key != "csrftoken")
+    )
+
+
+def apply_edits(conn, edits):
+    """
+    Write a list of edits - metadata values plus one history row each - in a
+    single transaction. Each edit is a dictionary with target_type, database,
+    table, column, actor_id, updated_at, values (the resolved metadata keys
+    and values) and fields (the raw submitted form fields)
+    """
+    upserts = {}
+    history = []
+    for edit in edits:
+        params = {
+            "database_name": edit["database"],
+            "resource_name": edit["table"],
+            "column_name": edit["column"],
+        }
+        upserts.setdefault(edit["target_type"], []).extend(
+            dict(params, key=key, value=value) for key, value in edit["values"].items()
+        )
+        history.append(
+            dict(
+                params,
+                target_type=edit["target_type"],
+                actor_id=edit["actor_id"],
+                updated_at=edit["updated_at"],
+                fields_json=history_fields_json(edit["fields"]),
+            )
+        )
+    # One executemany() per statement, however many edits there are
+    with conn:
+        for target_type, rows in upserts.items():
+            conn.executemany(UPSERT_SQL[target_type], rows)
+        conn.executemany(HISTORY_SQL, history)
@@ -1,8 +1,19 @@
+from click.testing import CliRunner
 from datasette.app import Datasette
+from datasette.cli import cli
+from datasette.utils import StartupError
 from datasette_metadata_editable import internal_migrations
+from datasette_metadata_editable.admission import EditAdmission
+from datasette_metadata_editable.write_queue import WriteBehindQueue
+import asyncio
+import datetime
 import json
+import pathlib
 import pytest
+import sqlite3
 import sqlite_utils
+import urllib.parse
+import yaml
 
 
 @pytest.mark.asyncio
@@ -448,3 +459,1087 @@ async def test_edit_history_is_used_to_prefill_form(tmpdir):
         '<textarea id="description_markdown" name="description_markdown" cols="80" rows="4">**DESCRIBED!**</textarea>'
         in response3.text
     )
+
+
+@pytest.mark.asyncio
+async def test_write_behind_coalesces_edits_and_flushes_on_shutdown(tmpdir):
+    internal = str(tmpdir / "internal.db")
+    db_path = str(tmpdir / "test.db")
+    sqlite_utils.Database(db_path).vacuum()
+    datasette = Datasette(
+        [db_path],
+        config={
+            "permissions": {"datasette-metadata-editable-edit": {"id": ["root"]}},
+            "plugins": {
+                "datasette-metadata-editable": {
+                    "write_behind": True,
+                    # Long enough that only the shutdown flush writes anything
+                    "write_behind_window": 60,
+                }
+            },
+        },
+        internal=internal,
+    )
+    await datasette.refresh_schemas()
+    db = datasette.get_database("test")
+    await db.execute_write("create table t(id integer primary key)")
+    cookies = {"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")}
+    response = await datasette.client.get(
+        "/-/datasette-metadata-editable/edit", cookies=cookies
+    )
+    csrftoken = response.cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+
+    for description in ("one", "two", "three"):
+        response2 = await datasette.client.post(
+            "/-/datasette-metadata-editable/api/edit",
+            cookies=cookies,
+            data={
+                "csrftoken": csrftoken,
+                "target_type": "database",
+                "_database": "test",
+                "description_markdown": description,
+            },
+        )
+        assert response2.status_code == 302
+    response3 = await datasette.client.post(
+        "/-/datasette-metadata-editable/api/edit",
+        cookies=cookies,
+        data={
+            "csrftoken": csrftoken,
+            "target_type": "table",
+            "_database": "test",
+            "_table": "t",
+            "license": "MIT",
+        },
+    )
+    assert response3.status_code == 302
+
+    # Nothing has been written yet, but the edit page shows the pending edit
+    sqlite_db = sqlite_utils.Database(internal)
+    assert list(sqlite_db["datasette_metadata_editable_history"].rows) == []
+    response4 = await datasette.client.get(
+        "/-/datasette-metadata-editable/edit?db=test", cookies=cookies
+    )
+    assert (
+        '<textarea id="description_markdown" name="description_markdown" cols="80" rows="4">three</textarea>'
+        in response4.text
+    )
+
+    # Simulate an ASGI server shutting down
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    await datasette.app()({"type": "lifespan"}, receive, send)
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+
+    history = list(sqlite_db["datasette_metadata_editable_history"].rows)
+    assert [(row["target_type"], row["resource_name"]) for row in history] == [
+        ("database", None),
+        ("table", "t"),
+    ]
+    assert json.loads(history[0]["fields_json"])["description_markdown"] == "three"
+    assert (await datasette.get_database_metadata("test"))[
+        "description_html"
+    ] == "<p>three</p>\n"
+    assert (await datasette.get_resource_metadata("test", "t"))["license"] == "MIT"
+
+    stats = (
+        await datasette.client.get(
+            "/-/datasette-metadata-editable/api/stats", cookies=cookies
+        )
+    ).json()
+    assert stats["write_queue"] == {
+        "window": 60.0,
+        "pending": 0,
+        "edits_submitted": 4,
+        "edits_written": 2,
+        "flushes": 1,
+        "coalescing_ratio": 2.0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_write_behind_retries_failed_flush_and_late_edits(tmpdir, caplog):
+    datasette = Datasette(memory=True, internal=str(tmpdir / "internal.db"))
+    await datasette.refresh_schemas()
+    queue = WriteBehindQueue(datasette, window=0.05)
+
+    def edit(description):
+        return {
+            "target_type": "database",
+            "database": "_memory",
+            "table": None,
+            "column": None,
+            "actor_id": None,
+            "updated_at": "2024-01-01T00:00:00",
+            "values": {"description_html": description},
+            "fields": {"description_markdown": description},
+        }
+
+    # The history table does not exist until startup runs the migrations
+    await queue.enqueue(edit("one"))
+    with pytest.raises(sqlite3.OperationalError):
+        await queue.flush()
+    assert queue.get_pending("database", "_memory", None, None)["values"] == {
+        "description_html": "one"
+    }
+    # Shutting down logs the edits that could not be written, without raising
+    closing_queue = WriteBehindQueue(datasette, window=60)
+    await closing_queue.enqueue(edit("lost"))
+    await closing_queue.close()
+    assert "1 queued edits could not be written before shutdown" in caplog.text
+    await datasette.invoke_startup()
+    await queue.flush()
+    assert (await datasette.get_database_metadata("_memory"))[
+        "description_html"
+    ] == "one"
+
+    # An edit that arrives while the background flush is writing still gets
+    # written, without waiting for another save
+    async def on_flush(edits):
+        if edits[0]["values"]["description_html"] == "two":
+            await queue.enqueue(edit("three"))
+
+    queue.on_flush = on_flush
+    await queue.enqueue(edit("two"))
+    await asyncio.sleep(0.5)
+    assert (await datasette.get_database_metadata("_memory"))[
+        "description_html"
+    ] == "three"
+    stats = queue.stats()
+    assert stats["pending"] == 0
+    assert stats["edits_written"] == 3
+    assert stats["coalescing_ratio"] == 1.0
+
+
+@pytest.mark.asyncio
+async def test_export_and_import_metadata_file(tmpdir):
+    internal = str(tmpdir / "internal.db")
+    metadata_file = str(tmpdir / "metadata.yml")
+    datasette = Datasette(memory=True, internal=internal)
+    await datasette.refresh_schemas()
+    await datasette.invoke_startup()
+    await datasette.set_instance_metadata("title", "My instance")
+    await datasette.set_database_metadata("data", "source", "Source")
+    await datasette.set_column_metadata("data", "t", "id", "description_html", "ID")
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["metadata-editable", "export", internal, metadata_file]
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output == "Wrote {}\n".format(metadata_file)
+    assert yaml.safe_load(pathlib.Path(metadata_file).read_text()) == {
+        "title": "My instance",
+        "databases": {
+            "data": {
+                "source": "Source",
+                "tables": {"t": {"columns": {"id": {"description_html": "ID"}}}},
+            }
+        },
+    }
+    # Exporting again leaves the file alone
+    result2 = runner.invoke(
+        cli, ["metadata-editable", "export", internal, metadata_file]
+    )
+    assert result2.output == "{} is already up to date\n".format(metadata_file)
+
+    # Edit the file and import it - only changed targets should be written
+    pathlib.Path(metadata_file).write_text(
+        yaml.safe_dump(
+            {
+                "title": "My instance",
+                "databases": {
+                    "data": {
+                        "license": "MIT",
+                        "tables": {
+                            "t": {
+                                "columns": {"id": {"description_html": "ID"}},
+                            },
+                            "t2": {"source": "Another source"},
+                        },
+                    }
+                },
+            },
+        )
+    )
+    result3 = runner.invoke(
+        cli,
+        ["metadata-editable", "import", internal, metadata_file, "--actor", "git"],
+    )
+    assert result3.exit_code == 0, result3.output
+    assert result3.output == "Updated 2 targets\n"
+
+    sqlite_db = sqlite_utils.Database(internal)
+    assert list(sqlite_db["metadata_databases"].rows) == [
+        {"database_name": "data", "key": "source", "value": None},
+        {"database_name": "data", "key": "license", "value": "MIT"},
+    ]
+    assert list(sqlite_db["metadata_resources"].rows) == [
+        {
+            "database_name": "data",
+            "resource_name": "t2",
+            "key": "source",
+            "value": "Another source",
+        }
+    ]
+    history = list(sqlite_db["datasette_metadata_editable_history"].rows)
+    assert [
+        (row["target_type"], row["resource_name"], row["actor_id"]) for row in history
+    ] == [("database", None, "git"), ("table", "t2", "git")]
+    assert json.loads(history[0]["fields_json"]) == {
+        "target_type": "database",
+        "_database": "data",
+        "license": "MIT",
+        "source": None,
+    }
+
+    # Importing the same file again is a no-op
+    result4 = runner.invoke(
+        cli, ["metadata-editable", "import", internal, metadata_file]
+    )
+    assert result4.output == "Updated 0 targets\n"
+
+
+@pytest.mark.asyncio
+async def test_history_export(tmpdir):
+    internal = str(tmpdir / "internal.db")
+    datasette = Datasette(
+        memory=True,
+        config={"permissions": {"datasette-metadata-editable-edit": {"id": ["root"]}}},
+        internal=internal,
+    )
+    await datasette.refresh_schemas()
+    await datasette.invoke_startup()
+    sqlite_utils.Database(internal)["datasette_metadata_editable_history"].insert_all(
+        {
+            "target_type": "database",
+            "database_name": "db{}".format(i % 3),
+            "actor_id": "bot" if i % 2 else "root",
+            "updated_at": "2024-01-01T00:{:02d}:{:02d}".format(i // 60, i % 60),
+            "fields_json": json.dumps({"description_markdown": str(i)}),
+        }
+        for i in range(2500)
+    )
+    cookies = {"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")}
+
+    # Anonymous users cannot export history
+    anon_response = await datasette.client.get(
+        "/-/datasette-metadata-editable/api/history.ndjson"
+    )
+    assert anon_response.status_code == 403
+
+    response = await datasette.client.get(
+        "/-/datasette-metadata-editable/api/history.ndjson", cookies=cookies
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson; charset=utf-8"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert len(rows) == 2500
+    assert [row["id"] for row in rows] == list(range(1, 2501))
+    assert rows[0] == {
+        "id": 1,
+        "target_type": "database",
+        "database_name": "db0",
+        "resource_name": None,
+        "column_name": None,
+        "actor_id": "root",
+        "updated_at": "2024-01-01T00:00:00",
+        "fields_json": '{"description_markdown": "0"}',
+    }
+
+    # Filters
+    response2 = await datasette.client.get(
+        "/-/datasette-metadata-editable/api/history.ndjson?actor=bot&database=db1"
+        "&since=2024-01-01T00:01:00&until=2024-01-01T00:02:00",
+        cookies=cookies,
+    )
+    rows2 = [json.loads(line) for line in response2.text.splitlines()]
+    assert [row["fields_json"] for row in rows2] == [
+        json.dumps({"description_markdown": str(i)})
+        for i in range(60, 120)
+        if i % 2 and i % 3 == 1
+    ]
+
+    # CSV
+    response3 = await datasette.client.get(
+        "/-/datasette-metadata-editable/api/history.csv?actor=nobody", cookies=cookies
+    )
+    assert response3.headers["content-type"] == "text/csv; charset=utf-8"
+    assert response3.text == (
+        "id,target_type,database_name,resource_name,column_name,"
+        "actor_id,updated_at,fields_json\r\n"
+    )
+    response4 = await datasette.client.get(
+        "/-/datasette-metadata-editable/api/history.csv", cookies=cookies
+    )
+    assert len(response4.text.splitlines()) == 2501
+
+
+@pytest.mark.asyncio
+async def test_history_export_is_not_cut_off_by_sql_time_limit(tmpdir):
+    internal = str(tmpdir / "internal.db")
+    datasette = Datasette(
+        memory=True,
+        config={"permissions": {"datasette-metadata-editable-edit": {"id": ["root"]}}},
+        settings={"sql_time_limit_ms": 1},
+        internal=internal,
+    )
+    await datasette.refresh_schemas()
+    await datasette.invoke_startup()
+    # A rare actor means scanning lots of rows to find a few matches
+    sqlite_utils.Database(internal)["datasette_metadata_editable_history"].insert_all(
+        {
+            "target_type": "instance",
+            "actor_id": "rare" if i % 20000 == 0 else "common",
+            "updated_at": "2024-01-01T00:00:00",
+            "fields_json": "{}",
+        }
+        for i in range(1, 60001)
+    )
+    response = await datasette.client.get(
+        "/-/datasette-metadata-editable/api/history.ndjson?actor=rare",
+        cookies={"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")},
+    )
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == [
+        20000,
+        40000,
+        60000,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_metadata_as_of(tmpdir):
+    internal = str(tmpdir / "internal.db")
+    datasette = Datasette(
+        memory=True,
+        config={"permissions": {"datasette-metadata-editable-edit": {"id": ["root"]}}},
+        internal=internal,
+    )
+    await datasette.refresh_schemas()
+    await datasette.invoke_startup()
+
+    def edit(target_type, updated_at, database=None, table=None, column=None, **fields):
+        return {
+            "target_type": target_type,
+            "database_name": database,
+            "resource_name": table,
+            "column_name": column,
+            "actor_id": "root",
+            "updated_at": updated_at,
+            "fields_json": json.dumps(dict(fields, target_type=target_type)),
+        }
+
+    sqlite_utils.Database(internal)["datasette_metadata_editable_history"].insert_all(
+        [
+            edit("instance", "2024-01-01T00:00:00", title="First title"),
+            edit("instance", "2024-03-01T00:00:00", title="Second title"),
+            edit("database", "2024-01-02T00:00:00", "db", description_markdown="*db*"),
+            edit("table", "2024-01-03T00:00:00", "db", "t", source="Old source"),
+            edit("table", "2024-02-01T00:00:00", "db", "t", source="New source"),
+            # x is not a registered field, so was never saved
+            edit("column", "2024-01-04T00:00:00", "db", "t", "id", license="MIT", x=1),
+            edit("table", "2024-01-05T00:00:00", "other", "t", source="Tied"),
+            # Ties on updated_at go to the later entry
+            edit("table", "2024-01-05T00:00:00", "other", "t", source="Other"),
+        ]
+    )
+    cookies = {"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")}
+
+    async def get(query):
+        return (
+            await datasette.client.get(
+                "/-/datasette-metadata-editable/api/metadata?" + query,
+                cookies=cookies,
+            )
+        ).json()
+
+    assert await get("as_of=2023-12-31") == {}
+    assert await get("as_of=2024-01-15") == {
+        "title": "First title",
+        "databases": {
+            "db": {
+                "description_html": "<p><em>db</em></p>\n",
+                "tables": {
+                    "t": {
+                        "source": "Old source",
+                        "columns": {"id": {"license": "MIT"}},
+                    }
+                },
+            },
+            "other": {"tables": {"t": {"source": "Other"}}},
+        },
+    }
+    assert await get("as_of=2024-02-01T00:00:00&db=db&table=t") == {
+        "databases": {
+            "db": {
+                "tables": {
+                    "t": {
+                        "source": "New source",
+                        "columns": {"id": {"license": "MIT"}},
+                    }
+                }
+            }
+        }
+    }
+    assert (await get("as_of=2024-12-01"))["title"] == "Second title"
+    # Timestamps with an offset are compared in the server's local time, here
+    # an hour before the table's source changed
+    as_of = (
+        datetime.datetime(2024, 1, 31, 23)
+        .astimezone(datetime.timezone(datetime.timedelta(hours=5)))
+        .isoformat()
+    )
+    response = await get("db=db&table=t&as_of=" + urllib.parse.quote(as_of))
+    assert response["databases"]["db"]["tables"]["t"]["source"] == "Old source"
+    assert await get("as_of=yesterday") == {
+        "ok": False,
+        "error": "as_of must be an ISO 8601 timestamp",
+    }
+    # A table needs its database, and a column its table
+    for query in ("table=t", "table=t&as_of=2100-01-01", "db=db&column=id"):
+        assert await get(query) == {
+            "ok": False,
+            "error": "table= needs db=, and column= needs table=",
+        }
+
+    # Without as_of the current metadata is returned
+    await datasette.set_database_metadata("db", "source", "Current")
+    await datasette.set_database_metadata("other", "source", "Elsewhere")
+    assert await get("db=db") == {"databases": {"db": {"source": "Current"}}}
+
+
+@pytest.mark.asyncio
+async def test_revision_diff(tmpdir):
+    internal = str(tmpdir / "internal.db")
+    datasette = Datasette(
+        memory=True,
+        config={"permissions": {"datasette-metadata-editable-edit": {"id": ["root"]}}},
+        internal=internal,
+    )
+    datasette.add_memory_database("db")
+    await datasette.refresh_schemas()
+    cookies = {"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")}
+    response = await datasette.client.get(
+        "/-/datasette-metadata-editable/edit", cookies=cookies
+    )
+    csrftoken = response.cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+
+    for fields in (
+        {"description_markdown": "Line one\nLine two", "license": "MIT"},
+        {"target_type": "instance", "title": "Unrelated"},
+        {"description_markdown": "Line one\nLine 2", "license": "MIT"},
+        {"description_markdown": "Line one\nLine 2", "source": "Source"},
+    ):
+        await datasette.client.post(
+            "/-/datasette-metadata-editable/api/edit",
+            cookies=cookies,
+            data=dict(
+                {"csrftoken": csrftoken, "target_type": "database", "_database": "db"},
+                **fields,
+            ),
+        )
+
+    async def get(query):
+        return await datasette.client.get(
+            "/-/datasette-metadata-editable/api/diff?" + query, cookies=cookies
+        )
+
+    diff = (await get("to=3")).json()
+    assert diff["target"] == {
+        "target_type": "database",
+        "database": "db",
+        "table": None,
+        "column": None,
+    }
+    assert diff["from"]["id"] == 1
+    assert diff["to"]["id"] == 3
+    assert diff["to"]["actor_id"] == "root"
+    assert diff["changes"] == [
+        {
+            "field": "description_markdown",
+            "from": "Line one\nLine two",
+            "to": "Line one\nLine 2",
+            "lines": [
+                "--- ",
+                "+++ ",
+                "@@ -1,2 +1,2 @@",
+                " Line one",
+                "-Line two",
+                "+Line 2",
+            ],
+        }
+    ]
+    assert diff["previous"] is None
+    assert diff["next"] == 4
+
+    diff2 = (await get("from=1&to=4")).json()
+    assert [change["field"] for change in diff2["changes"]] == [
+        "description_markdown",
+        "license",
+        "source",
+    ]
+
+    # The first revision is compared against nothing
+    diff3 = (await get("to=1")).json()
+    assert diff3["from"] is None
+    assert [change["field"] for change in diff3["changes"]] == [
+        "description_markdown",
+        "license",
+    ]
+
+    # Diffs are cached by revision pair
+    await get("to=3")
+    stats = (
+        await datasette.client.get(
+            "/-/datasette-metadata-editable/api/stats", cookies=cookies
+        )
+    ).json()
+    assert stats["diff_cache"] == {"maxsize": 256, "size": 3, "hits": 1, "misses": 3}
+
+    # Errors
+    assert (await get("from=2&to=3")).status_code == 400
+    assert (await get("to=99")).status_code == 404
+    assert (await get("to=three")).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_edit_rate_limits():
+    datasette = Datasette(
+        memory=True,
+        config={
+            "permissions": {"datasette-metadata-editable-edit": True},
+            "plugins": {
+                "datasette-metadata-editable": {
+                    "edits_per_second": 0.01,
+                    "edit_burst": 2,
+                    "max_outstanding_edits": 5,
+                }
+            },
+        },
+    )
+    await datasette.refresh_schemas()
+
+    async def post(actor_id):
+        cookies = {"ds_actor": datasette.sign({"a": {"id": actor_id}}, "actor")}
+        response = await datasette.client.get(
+            "/-/datasette-metadata-editable/edit", cookies=cookies
+        )
+        csrftoken = response.cookies["ds_csrftoken"]
+        cookies["ds_csrftoken"] = csrftoken
+        return await datasette.client.post(
+            "/-/datasette-metadata-editable/api/edit",
+            cookies=cookies,
+            data={"csrftoken": csrftoken, "target_type": "instance", "title": "yo"},
+        )
+
+    assert (await post("one")).status_code == 302
+    assert (await post("one")).status_code == 302
+    response = await post("one")
+    assert response.status_code == 429
+    assert 90 < int(response.headers["retry-after"]) <= 100
+    # Other actors have their own limit
+    assert (await post("two")).status_code == 302
+
+    stats = (
+        await datasette.client.get(
+            "/-/datasette-metadata-editable/api/stats",
+            cookies={"ds_actor": datasette.sign({"a": {"id": "one"}}, "actor")},
+        )
+    ).json()
+    assert stats["admission"] == {
+        "edits_per_second": 0.01,
+        "edit_burst": 2,
+        "max_outstanding_edits": 5,
+        "outstanding": 0,
+        "peak_outstanding": 1,
+        "admitted": 3,
+        "rejected_rate_limit": 1,
+        "rejected_outstanding": 0,
+        "actors_tracked": 2,
+    }
+
+
+def test_edit_admission_max_outstanding():
+    admission = EditAdmission(max_outstanding=2)
+    assert admission.admit("one") is None
+    assert admission.admit("two") is None
+    assert admission.admit("three") == 1.0
+    admission.release()
+    assert admission.admit("three") is None
+    # Edits waiting in the write-behind queue count towards the limit
+    admission.release()
+    assert admission.admit("four", queued=1) == 1.0
+    assert admission.rejected_outstanding == 2
+
+
+def test_load_test_command():
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "metadata-editable",
+            "load-test",
+            "--actors",
+            "3",
+            "--edits",
+            "4",
+            "--databases",
+            "1",
+            "--tables",
+            "2",
+            "--columns",
+            "2",
+            "--write-behind",
+            "--write-behind-window",
+            "0.01",
+            "--json",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    report = json.loads(result.output)
+    assert report["actors"] == 3
+    assert report["targets"] == 7
+    assert report["requests"] == 24
+    assert report["errors"] == 0
+    assert set(report["latency_ms"]["api_edit"]) == {"p50", "p90", "p99", "max"}
+    assert set(report["write_queue_depth"]) == {"max", "mean"}
+    assert report["write_behind"]["edits_submitted"] == 12
+    assert report["write_behind"]["pending"] == 0
+
+
+@pytest.mark.asyncio
+async def test_bulk_edit_columns(tmpdir):
+    internal = str(tmpdir / "internal.db")
+    datasette = Datasette(
+        memory=True,
+        config={"permissions": {"datasette-metadata-editable-edit": {"id": ["root"]}}},
+        internal=internal,
+    )
+    await datasette.refresh_schemas()
+    one = datasette.add_memory_database("bulk_one")
+    two = datasette.add_memory_database("bulk_two")
+    await one.execute_write_script(
+        """
+        create table if not exists users (id integer primary key, created_at text);
+        create table if not exists posts (id integer primary key, user_id integer, created_at text);
+        """
+    )
+    await two.execute_write(
+        "create table if not exists events (created_at text, created_by text)"
+    )
+    cookies = {"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")}
+    response = await datasette.client.get(
+        "/-/datasette-metadata-editable/edit", cookies=cookies
+    )
+    csrftoken = response.cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+
+    response2 = await datasette.client.post(
+        "/-/datasette-metadata-editable/api/bulk-edit-columns",
+        cookies=cookies,
+        data={
+            "csrftoken": csrftoken,
+            "column": "created_at",
+            "description_markdown": "When the row was *created*",
+        },
+    )
+    assert response2.status_code == 200
+    assert response2.json() == {
+        "ok": True,
+        "updated": 3,
+        "columns": [
+            {"database": "bulk_one", "table": "posts", "column": "created_at"},
+            {"database": "bulk_one", "table": "users", "column": "created_at"},
+            {"database": "bulk_two", "table": "events", "column": "created_at"},
+        ],
+    }
+    assert (await datasette.get_column_metadata("bulk_two", "events", "created_at"))[
+        "description_html"
+    ] == "<p>When the row was <em>created</em></p>\n"
+    history = list(
+        sqlite_utils.Database(internal)["datasette_metadata_editable_history"].rows
+    )
+    assert [(row["resource_name"], row["column_name"]) for row in history] == [
+        ("posts", "created_at"),
+        ("users", "created_at"),
+        ("events", "created_at"),
+    ]
+
+    # Patterns, limited to one database
+    response3 = await datasette.client.post(
+        "/-/datasette-metadata-editable/api/bulk-edit-columns",
+        cookies=cookies,
+        data={
+            "csrftoken": csrftoken,
+            "column": "created_*",
+            "database": "bulk_two",
+            "source": "Events feed",
+        },
+    )
+    assert [column["column"] for column in response3.json()["columns"]] == [
+        "created_at",
+        "created_by",
+    ]
+    # Fields that were not included are left alone
+    assert await datasette.get_column_metadata("bulk_two", "events", "created_at") == {
+        "description_html": "<p>When the row was <em>created</em></p>\n",
+        "source": "Events feed",
+    }
+    # The column's latest history entry still records its full state
+    history = list(
+        sqlite_utils.Database(internal)["datasette_metadata_editable_history"].rows
+    )
+    assert json.loads(history[-2]["fields_json"]) == {
+        "target_type": "column",
+        "_database": "bulk_two",
+        "_table": "events",
+        "_column": "created_at",
+        "description_markdown": "When the row was *created*",
+        "source": "Events feed",
+    }
+
+    # A pattern is required
+    response4 = await datasette.client.post(
+        "/-/datasette-metadata-editable/api/bulk-edit-columns",
+        cookies=cookies,
+        data={"csrftoken": csrftoken, "source": "Nowhere"},
+    )
+    assert response4.status_code == 400
+
+    # So is at least one field to update
+    response5 = await datasette.client.post(
+        "/-/datasette-metadata-editable/api/bulk-edit-columns",
+        cookies=cookies,
+        data={"csrftoken": csrftoken, "column": "*"},
+    )
+    assert response5.status_code == 400
+    assert response5.json()["error"] == "No fields to update were provided"
+
+
+@pytest.mark.asyncio
+async def test_edit_targets_are_validated(tmpdir):
+    internal = str(tmpdir / "internal.db")
+    db_path = str(tmpdir / "valid.db")
+    sqlite_utils.Database(db_path)["t"].create({"id": int})
+    datasette = Datasette(
+        [db_path],
+        config={"permissions": {"datasette-metadata-editable-edit": {"id": ["root"]}}},
+        internal=internal,
+    )
+    await datasette.refresh_schemas()
+    cookies = {"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")}
+    response = await datasette.client.get(
+        "/-/datasette-metadata-editable/edit", cookies=cookies
+    )
+    csrftoken = response.cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+
+    async def post(**fields):
+        return await datasette.client.post(
+            "/-/datasette-metadata-editable/api/edit",
+            cookies=cookies,
+            data=dict(fields, csrftoken=csrftoken, source="Source"),
+        )
+
+    for fields, error in (
+        ({"target_type": "database", "_database": "typo"}, "Database not found: typo"),
+        (
+            {"target_type": "table", "_database": "valid", "_table": "nope"},
+            "Table not found: nope",
+        ),
+        (
+            {
+                "target_type": "column",
+                "_database": "valid",
+                "_table": "t",
+                "_column": "name",
+            },
+            "Column not found: name",
+        ),
+    ):
+        response2 = await post(**fields)
+        assert response2.status_code == 400
+        assert response2.text == error
+
+    # Nothing was written for the bogus targets
+    sqlite_db = sqlite_utils.Database(internal)
+    assert list(sqlite_db["datasette_metadata_editable_history"].rows) == []
+
+    response3 = await post(
+        target_type="column", _database="valid", _table="t", _column="id"
+    )
+    assert response3.status_code == 302
+
+    # A schema change is picked up straight away
+    await datasette.get_database("valid").execute_write(
+        "alter table t add column name text"
+    )
+    response4 = await post(
+        target_type="column", _database="valid", _table="t", _column="name"
+    )
+    assert response4.status_code == 302
+
+    # Views and their columns can be edited too
+    await datasette.get_database("valid").execute_write(
+        "create view v as select id from t"
+    )
+    response5 = await post(
+        target_type="column", _database="valid", _table="v", _column="id"
+    )
+    assert response5.status_code == 302
+    response6 = await post(
+        target_type="column", _database="valid", _table="v", _column="name"
+    )
+    assert response6.text == "Column not found: name"
+
+    # A table created while another schema refresh is running is not in the
+    # catalog yet, but is still accepted
+    async with datasette._refresh_schemas_lock:
+        await datasette.get_database("valid").execute_write(
+            "create table fresh (id integer)"
+        )
+        response7 = await post(
+            target_type="column", _database="valid", _table="fresh", _column="id"
+        )
+        assert response7.status_code == 302
+        response8 = await post(target_type="table", _database="valid", _table="stale")
+        assert response8.text == "Table not found: stale"
+
+
+@pytest.mark.asyncio
+async def test_configured_fields(tmpdir):
+    internal = str(tmpdir / "internal.db")
+    db_path = str(tmpdir / "fields.db")
+    sqlite_utils.Database(db_path)["t"].create({"id": int, "weight": float})
+    datasette = Datasette(
+        [db_path],
+        config={
+            "permissions": {"datasette-metadata-editable-edit": {"id": ["root"]}},
+            "plugins": {
+                "datasette-metadata-editable": {
+                    "fields": {
+                        "table": ["about", "about_url", "label_column"],
+                        "column": [
+                            "units",
+                            {"name": "example", "label": "Example value"},
+                            {
+                                "name": "notes",
+                                "key": "notes_html",
+                                "type": "textarea",
+                                "renderer": "markdown",
+                            },
+                            {"name": "reference", "key": "reference_value"},
+                        ],
+                    }
+                }
+            },
+        },
+        internal=internal,
+    )
+    await datasette.refresh_schemas()
+    cookies = {"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")}
+    response = await datasette.client.get(
+        "/-/datasette-metadata-editable/edit?db=fields&table=t&column=weight",
+        cookies=cookies,
+    )
+    assert '<label for="units">Units</label>' in response.text
+    assert '<label for="example">Example value</label>' in response.text
+    assert '<label for="about">' not in response.text
+    csrftoken = response.cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+
+    response2 = await datasette.client.post(
+        "/-/datasette-metadata-editable/api/edit",
+        cookies=cookies,
+        data={
+            "csrftoken": csrftoken,
+            "target_type": "column",
+            "_database": "fields",
+            "_table": "t",
+            "_column": "weight",
+            "description_markdown": "Weight",
+            "units": "kg",
+            "example": "1.5",
+            "notes": "Measured *wet*",
+            "reference": "hello",
+        },
+    )
+    assert response2.status_code == 302
+    assert await datasette.get_column_metadata("fields", "t", "weight") == {
+        "description_html": "<p>Weight</p>\n",
+        "source": None,
+        "license": None,
+        "source_url": None,
+        "license_url": None,
+        "units": "kg",
+        "example": "1.5",
+        "notes_html": "<p>Measured <em>wet</em></p>\n",
+        "reference_value": "hello",
+    }
+    # The edit form shows the Markdown that was submitted, not the HTML
+    response_notes = await datasette.client.get(
+        "/-/datasette-metadata-editable/edit?db=fields&table=t&column=weight",
+        cookies=cookies,
+    )
+    assert (
+        '<textarea id="notes" name="notes" cols="80" rows="4">Measured *wet*</textarea>'
+        in response_notes.text
+    )
+    # Fields saved under a different key show their stored value
+    assert (
+        '<input type="text" id="reference" name="reference" value="hello">'
+        in response_notes.text
+    )
+
+    response3 = await datasette.client.get(
+        "/-/datasette-metadata-editable/edit?db=fields&table=t", cookies=cookies
+    )
+    assert '<label for="label_column">Label column</label>' in response3.text
+    assert '<label for="about_url">About URL</label>' in response3.text
+    await datasette.client.post(
+        "/-/datasette-metadata-editable/api/edit",
+        cookies=cookies,
+        data={
+            "csrftoken": csrftoken,
+            "target_type": "table",
+            "_database": "fields",
+            "_table": "t",
+            "about": "About this table",
+            "about_url": "https://example.com/",
+            "label_column": "id",
+        },
+    )
+    metadata = await datasette.get_resource_metadata("fields", "t")
+    assert metadata["about"] == "About this table"
+    assert metadata["about_url"] == "https://example.com/"
+    assert metadata["label_column"] == "id"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "fields,error",
+    (
+        (
+            {"column": [{"name": "notes", "renderer": "markdwon"}]},
+            "Unknown renderer for field notes: markdwon",
+        ),
+        ({"columns": ["units"]}, "Unknown target type in fields: columns"),
+    ),
+)
+async def test_invalid_fields_config_fails_at_startup(fields, error):
+    datasette = Datasette(
+        memory=True,
+        config={"plugins": {"datasette-metadata-editable": {"fields": fields}}},
+    )
+    with pytest.raises(StartupError) as ex:
+        await datasette.invoke_startup()
+    assert str(ex.value) == "datasette-metadata-editable: " + error
+
+
+@pytest.mark.asyncio
+async def test_embed_metadata_in_database_file(tmpdir):
+    db_path = str(tmpdir / "shipped.db")
+    sqlite_utils.Database(db_path)["t"].create({"id": int, "name": str})
+    config = {
+        "permissions": {"datasette-metadata-editable-edit": {"id": ["root"]}},
+        "plugins": {"datasette-metadata-editable": {"embed_metadata": True}},
+    }
+    datasette = Datasette(
+        [db_path], config=config, internal=str(tmpdir / "internal.db")
+    )
+    await datasette.refresh_schemas()
+    cookies = {"ds_actor": datasette.sign({"a": {"id": "root"}}, "actor")}
+    response = await datasette.client.get(
+        "/-/datasette-metadata-editable/edit", cookies=cookies
+    )
+    csrftoken = response.cookies["ds_csrftoken"]
+    cookies["ds_csrftoken"] = csrftoken
+
+    async def post(**fields):
+        response = await datasette.client.post(
+            "/-/datasette-metadata-editable/api/edit",
+            cookies=cookies,
+            data=dict(fields, csrftoken=csrftoken, _database="shipped"),
+        )
+        assert response.status_code == 302
+
+    await post(target_type="database", source="Shipped source")
+    await post(target_type="table", _table="t", description_markdown="Table T")
+    await post(target_type="column", _table="t", _column="name", license="MIT")
+
+    def embedded():
+        return {
+            (row["target_type"], row["table_name"], row["column_name"], row["key"]): (
+                row["rowid"],
+                row["value"],
+            )
+            for row in sqlite_utils.Database(db_path).query(
+                "select rowid, * from _datasette_metadata"
+            )
+        }
+
+    before = embedded()
+    assert {key: value for key, (_, value) in before.items()} == {
+        ("database", "", "", "source"): "Shipped source",
+        ("table", "t", "", "description_html"): "<p>Table T</p>\n",
+        ("column", "t", "name", "license"): "MIT",
+    }
+
+    # Only the edited target is rewritten
+    await post(target_type="table", _table="t", description_markdown="Updated")
+    after = embedded()
+    assert after[("table", "t", "", "description_html")][1] == "<p>Updated</p>\n"
+    assert (
+        after[("database", "", "", "source")] == before[("database", "", "", "source")]
+    )
+    assert (
+        after[("column", "t", "name", "license")]
+        == before[("column", "t", "name", "license")]
+    )
+
+    # A new server with a fresh internal database loads the embedded metadata
+    datasette2 = Datasette(
+        [db_path], config=config, internal=str(tmpdir / "internal2.db")
+    )
+    await datasette2.invoke_startup()
+    assert (await datasette2.get_database_metadata("shipped"))[
+        "source"
+    ] == "Shipped source"
+    assert (await datasette2.get_resource_metadata("shipped", "t"))[
+        "description_html"
+    ] == "<p>Updated</p>\n"
+    assert (await datasette2.get_column_metadata("shipped", "t", "name")) == {
+        "license": "MIT"
+    }
+
+    # Concurrent saves are synced one at a time, ending with the latest values
+    await asyncio.gather(
+        *(post(target_type="database", source="Source {}".format(i)) for i in range(5))
+    )
+    source = (await datasette.get_database_metadata("shipped"))["source"]
+    assert embedded()[("database", "", "", "source")][1] == source
+    internal = sqlite_utils.Database(str(tmpdir / "internal.db"))
+    assert (
+        internal["datasette_metadata_editable_embedded"].get("shipped")[
+            "last_history_id"
+        ]
+        == internal.execute(
+            "select max(id) from datasette_metadata_editable_history"
+        ).fetchone()[0]
+    )
+
+    # A failure writing to the database file does not fail the save
+    sqlite_utils.Database(db_path).executescript(
+        "drop table _datasette_metadata; create table _datasette_metadata (id integer)"
+    )
+    await post(target_type="database", source="Still saved")
+    assert (await datasette.get_database_metadata("shipped"))["source"] == "Still saved"